@@ -0,0 +1,148 @@
+''' Headless benchmark of the plugin hot paths against a synthetic project. Uses the stand-in sublime modules
+in this directory so it runs in plain CPython:
+
+    python bench/bench_signet.py --files 10000 --sigs 100000
+
+Reports the time and the plugin_host API calls for each step.
+'''
+import sys
+import os
+import json
+import time
+import random
+import argparse
+import tempfile
+import importlib.util
+
+# The stand-ins must be found before anything imports the real ones.
+_bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, _bench_dir)
+
+import sublime
+import sublime_plugin
+
+
+#-----------------------------------------------------------------------------------
+def load_plugin():
+    ''' Import the plugin as a package like ST does so the relative imports work. '''
+    pkg_dir = os.path.dirname(_bench_dir)
+    spec = importlib.util.spec_from_file_location('SignetBookmarks', os.path.join(pkg_dir, '__init__.py'),
+                                                  submodule_search_locations=[pkg_dir])
+    pkg = importlib.util.module_from_spec(spec)
+    sys.modules['SignetBookmarks'] = pkg
+    return importlib.import_module('SignetBookmarks.sbot_signet')
+
+
+#-----------------------------------------------------------------------------------
+def make_project(num_files, num_sigs, line_count):
+    ''' Files on disk plus an old style single store holding the signets. Returns (project_fn, files). '''
+    root = tempfile.mkdtemp(prefix='sbot_bench_proj_')
+    project_fn = os.path.join(root, 'bench.sublime-project')
+    with open(project_fn, 'w') as fp:
+        fp.write('{}')
+
+    files = []
+    for i in range(num_files):
+        # Spread over some directories like a real tree.
+        dir = os.path.join(root, f'dir{i % 50}')
+        os.makedirs(dir, exist_ok=True)
+        fn = os.path.join(dir, f'file{i}.txt')
+        with open(fn, 'w'):
+            pass
+        files.append(fn)
+
+    rnd = random.Random(42)
+    sigs = {}
+    for _ in range(num_sigs):
+        fn = files[rnd.randrange(num_files)]
+        sigs.setdefault(fn, set()).add(rnd.randrange(1, line_count + 1))
+
+    store = {project_fn: {fn: sorted(rows) for fn, rows in sigs.items()}}
+    with open(os.path.join(sublime.packages_path(), 'User', 'SignetBookmarks', 'SignetBookmarks.store'), 'w') as fp:
+        json.dump(store, fp)
+
+    return project_fn, files
+
+
+#-----------------------------------------------------------------------------------
+def step(results, name, func):
+    ''' Time func and count the API calls it makes. '''
+    before = sublime.api_calls.copy()
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    calls = sublime.api_calls.copy()
+    calls.subtract(before)
+    results.append((name, elapsed, +calls))
+
+
+#-----------------------------------------------------------------------------------
+def report(results):
+    print(f'{"step":<28} {"msec":>10} {"api calls":>10}  top calls')
+    for name, elapsed, calls in results:
+        top = ', '.join(f'{k}:{v}' for k, v in calls.most_common(3))
+        print(f'{name:<28} {elapsed * 1000:>10.1f} {sum(calls.values()):>10}  {top}')
+
+
+#-----------------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the signet plugin hot paths.')
+    parser.add_argument('--files', type=int, default=10000, help='files in the project')
+    parser.add_argument('--sigs', type=int, default=100000, help='signets in the project')
+    parser.add_argument('--lines', type=int, default=2000, help='lines per file')
+    parser.add_argument('--open', type=int, default=200, help='files open in the window')
+    parser.add_argument('--ops', type=int, default=1000, help='toggles and gotos')
+    args = parser.parse_args()
+
+    ss = load_plugin()
+    ss.plugin_loaded()
+
+    project_fn, files = make_project(args.files, args.sigs, args.lines)
+    win = sublime.Window(project_fn, [os.path.dirname(project_fn)], line_count=args.lines)
+
+    results = []
+    ev = ss.SignetEvent()
+
+    step(results, 'migrate old store', ev._read_store)
+    step(results, 'read store', ev._read_store)
+
+    views = [win.open_file(fn) for fn in sorted(files)[:args.open]]
+    for view in views:
+        view._loading = False
+    sublime._timeouts.clear()
+
+    step(results, 'init views', lambda: ev.on_init(views))
+    step(results, 'validate in background', sublime.run_timeouts)
+
+    view = views[0]
+    cmd = ss.SbotToggleSignetCommand(view)
+
+    def _toggle():
+        for i in range(args.ops):
+            view.sel()[:] = [sublime.Region(view.text_point(i % args.lines, 0))]
+            cmd.run(None)
+    step(results, f'toggle x{args.ops}', _toggle)
+
+    def _goto(where):
+        win.focus_view(view)
+        for _ in range(args.ops):
+            active = win.active_view()
+            ss.SbotGotoSignetCommand(active).run(None, where)
+            sublime.run_timeouts()
+    step(results, f'goto next x{args.ops}', lambda: _goto('next'))
+    step(results, f'goto prev x{args.ops}', lambda: _goto('prev'))
+
+    def _deactivate():
+        for v in win.views():
+            ev.on_deactivated(v)
+    step(results, 'collect all views', _deactivate)
+    step(results, 'collect all views again', _deactivate)
+
+    step(results, 'write store', lambda: ev.on_pre_close_project(win))
+
+    print(f'files:{args.files} signets:{args.sigs} lines:{args.lines} open:{args.open}')
+    report(results)
+
+
+if __name__ == '__main__':
+    main()
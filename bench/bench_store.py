@@ -0,0 +1,97 @@
+''' Benchmark of the signet store engine on its own - no sublime, not even the stand-ins:
+
+    python bench/bench_store.py --files 10000 --sigs 100000
+
+Reports the time for each step.
+'''
+import sys
+import os
+import time
+import random
+import re
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from signet_store import SignetStore, line_fp, scan_files, walk_folders
+
+
+#-----------------------------------------------------------------------------------
+def step(results, name, func):
+    ''' Time func. '''
+    start = time.perf_counter()
+    func()
+    results.append((name, time.perf_counter() - start))
+
+
+#-----------------------------------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the signet store engine.')
+    parser.add_argument('--files', type=int, default=10000, help='files in the project')
+    parser.add_argument('--sigs', type=int, default=100000, help='signets in the project')
+    parser.add_argument('--lines', type=int, default=2000, help='lines per file')
+    parser.add_argument('--ops', type=int, default=10000, help='toggles and queries')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='sbot_bench_store_')
+    proj_fn = os.path.join(root, 'bench.sublime-project')
+    with open(proj_fn, 'w') as fp:
+        fp.write('{}')
+    files = []
+    for i in range(args.files):
+        # Real files as the store drops signets for ones that have gone.
+        dir = os.path.join(root, f'dir{i % 50}')
+        os.makedirs(dir, exist_ok=True)
+        fn = os.path.join(dir, f'file{i}.txt')
+        with open(fn, 'w') as fp:
+            fp.write(f'line one of {fn}\n# TODO {i}\nline three\n')
+        files.append(fn)
+
+    store_dir = os.path.join(root, 'store')
+    store = SignetStore(store_dir, 'SignetBookmarks')
+    store.read()
+    rnd = random.Random(42)
+    results = []
+
+    def _populate():
+        for _ in range(args.sigs):
+            fn = files[rnd.randrange(args.files)]
+            row = rnd.randrange(1, args.lines + 1)
+            if row not in store.get_rows(proj_fn, fn):
+                store.toggle(proj_fn, fn, row, line_fp(f'line {row} of {fn}'))
+    step(results, f'toggle on x{args.sigs}', _populate)
+    step(results, 'save', lambda: store.save(wait=True))
+    step(results, 'compact', lambda: (store.compact(proj_fn), store.save(wait=True)))
+
+    def _toggle():
+        for i in range(args.ops):
+            store.toggle(proj_fn, files[i % args.files], i % args.lines + 1)
+    step(results, f'toggle x{args.ops}', _toggle)
+    step(results, 'save journal', lambda: store.save(wait=True))
+
+    def _next(forward):
+        for i in range(args.ops):
+            store.find_next(proj_fn, files[i % args.files], i % args.lines + 1, forward)
+    step(results, f'find next x{args.ops}', lambda: _next(True))
+    step(results, f'find prev x{args.ops}', lambda: _next(False))
+
+    def _scan():
+        found = sum(len(rows) for _, rows, _ in scan_files(walk_folders([root], ('store',)), re.compile('TODO')))
+        assert found == args.files
+    step(results, 'walk and scan for TODO', _scan)
+
+    other = SignetStore(store_dir, 'SignetBookmarks')
+    step(results, 'read', other.read)
+    step(results, 'load project', lambda: other.get_project(proj_fn))
+    assert other.get_project(proj_fn) == store.get_project(proj_fn)
+
+    print(f'files:{args.files} signets:{args.sigs} lines:{args.lines}')
+    print(f'{"step":<28} {"msec":>10}')
+    for name, elapsed in results:
+        print(f'{name:<28} {elapsed * 1000:>10.1f}')
+    assert 'sublime' not in sys.modules
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,341 @@
+''' Stand-in for the ST sublime module so the plugin can run headless. Only what the plugin uses.
+Every View/Window call is counted in api_calls as it would be a plugin_host round trip in ST. '''
+import bisect
+import tempfile
+import collections
+
+
+KIND_AMBIGUOUS = (0, '', '')
+TRANSIENT = 4
+ENCODED_POSITION = 1
+
+# Plugin_host round trips by name.
+api_calls = collections.Counter()
+
+# Where User/... goes.
+_packages_path = tempfile.mkdtemp(prefix='sbot_bench_')
+
+_timeouts = []
+_windows = []
+_settings = {}
+_last_id = 0
+
+
+#-----------------------------------------------------------------------------------
+def _next_id():
+    global _last_id
+    _last_id += 1
+    return _last_id
+
+
+#-----------------------------------------------------------------------------------
+def packages_path():
+    return _packages_path
+
+
+#-----------------------------------------------------------------------------------
+def platform():
+    return 'linux'
+
+
+#-----------------------------------------------------------------------------------
+def set_timeout(f, delay=0):
+    ''' Queued until run_timeouts(). '''
+    del delay
+    _timeouts.append(f)
+
+
+#-----------------------------------------------------------------------------------
+def set_timeout_async(f, delay=0):
+    ''' Queued until run_timeouts(). '''
+    del delay
+    _timeouts.append(f)
+
+
+#-----------------------------------------------------------------------------------
+def run_timeouts():
+    ''' Bench only. Run everything queued, including anything queued while running. '''
+    while len(_timeouts) > 0:
+        _timeouts.pop(0)()
+
+
+#-----------------------------------------------------------------------------------
+def status_message(msg):
+    pass
+
+
+#-----------------------------------------------------------------------------------
+def error_message(msg):
+    print(f'error_message: {msg}')
+
+
+#-----------------------------------------------------------------------------------
+def message_dialog(msg):
+    print(f'message_dialog: {msg}')
+
+
+#-----------------------------------------------------------------------------------
+def windows():
+    api_calls['windows'] += 1
+    return list(_windows)
+
+
+#-----------------------------------------------------------------------------------
+def active_window():
+    return _windows[0] if len(_windows) > 0 else None
+
+
+#-----------------------------------------------------------------------------------
+def load_settings(fn):
+    api_calls['load_settings'] += 1
+    if fn not in _settings:
+        _settings[fn] = Settings({'scope': 'region.redish', 'nav_all_files': True})
+    return _settings[fn]
+
+
+#-----------------------------------------------------------------------------------
+class Settings():
+
+    def __init__(self, values):
+        self._values = values
+        self._on_change = {}
+
+    def get(self, key, default=None):
+        api_calls['Settings.get'] += 1
+        return self._values.get(key, default)
+
+    def set(self, key, value):
+        self._values[key] = value
+        for cb in list(self._on_change.values()):
+            cb()
+
+    def add_on_change(self, tag, cb):
+        self._on_change[tag] = cb
+
+    def clear_on_change(self, tag):
+        self._on_change.pop(tag, None)
+
+
+#-----------------------------------------------------------------------------------
+class Region():
+
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = a if b is None else b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def size(self):
+        return self.end() - self.begin()
+
+    def __len__(self):
+        return self.size()
+
+    def __eq__(self, other):
+        return isinstance(other, Region) and self.a == other.a and self.b == other.b
+
+    def __repr__(self):
+        return f'Region({self.a}, {self.b})'
+
+
+#-----------------------------------------------------------------------------------
+class QuickPanelItem():
+
+    def __init__(self, trigger, details='', annotation='', kind=KIND_AMBIGUOUS):
+        self.trigger = trigger
+        self.details = details
+        self.annotation = annotation
+        self.kind = kind
+
+
+#-----------------------------------------------------------------------------------
+class View():
+    ''' Text is a list of lines. If not supplied it's line_count made up lines. Regions don't move with edits. '''
+
+    def __init__(self, window, fn=None, lines=None, line_count=100):
+        self._id = _next_id()
+        self._window = window
+        self._fn = fn
+        self._scratch = False
+        self._loading = False
+        self._change_count = 0
+        self._regions = {}
+        self._sel = [Region(0)]
+        self.set_lines(lines if lines is not None else [f'line {i} of {fn}' for i in range(line_count)])
+
+    def set_lines(self, lines):
+        ''' Bench only. Replace the text like an edit or a reload would. '''
+        self._lines = lines
+        self._text = '\n'.join(lines)
+        self._offsets = []
+        pos = 0
+        for line in lines:
+            self._offsets.append(pos)
+            pos += len(line) + 1
+        self._size = len(self._text)
+        self._change_count += 1
+
+    def id(self):
+        api_calls['View.id'] += 1
+        return self._id
+
+    def buffer_id(self):
+        api_calls['View.buffer_id'] += 1
+        return self._id
+
+    def window(self):
+        api_calls['View.window'] += 1
+        return self._window
+
+    def file_name(self):
+        api_calls['View.file_name'] += 1
+        return self._fn
+
+    def is_scratch(self):
+        api_calls['View.is_scratch'] += 1
+        return self._scratch
+
+    def set_scratch(self, scratch):
+        self._scratch = scratch
+
+    def is_loading(self):
+        api_calls['View.is_loading'] += 1
+        return self._loading
+
+    def is_valid(self):
+        api_calls['View.is_valid'] += 1
+        return self._window is not None
+
+    def change_count(self):
+        api_calls['View.change_count'] += 1
+        return self._change_count
+
+    def size(self):
+        api_calls['View.size'] += 1
+        return self._size
+
+    def sel(self):
+        api_calls['View.sel'] += 1
+        return self._sel
+
+    def rowcol(self, pt):
+        api_calls['View.rowcol'] += 1
+        row = max(bisect.bisect_right(self._offsets, pt) - 1, 0)
+        return (row, pt - self._offsets[row])
+
+    def text_point(self, row, col):
+        api_calls['View.text_point'] += 1
+        if row >= len(self._offsets):
+            return self._size
+        return min(self._offsets[max(row, 0)] + col, self._size)
+
+    def line(self, x):
+        api_calls['View.line'] += 1
+        pt = x.a if isinstance(x, Region) else x
+        row = max(bisect.bisect_right(self._offsets, pt) - 1, 0)
+        return Region(self._offsets[row], self._offsets[row] + len(self._lines[row]))
+
+    def substr(self, x):
+        api_calls['View.substr'] += 1
+        return self._text[x.begin():x.end()] if isinstance(x, Region) else self._text[x]
+
+    def get_regions(self, key):
+        api_calls['View.get_regions'] += 1
+        return list(self._regions.get(key, []))
+
+    def add_regions(self, key, regions, scope='', icon='', flags=0):
+        api_calls['View.add_regions'] += 1
+        self._regions[key] = sorted(regions, key=lambda r: r.a)
+
+    def erase_regions(self, key):
+        api_calls['View.erase_regions'] += 1
+        self._regions.pop(key, None)
+
+    def run_command(self, cmd, args=None):
+        api_calls['View.run_command'] += 1
+        if cmd == 'goto_line':
+            pt = self.text_point(args['line'] - 1, 0)
+            self._sel[:] = [Region(pt)]
+
+
+#-----------------------------------------------------------------------------------
+class Window():
+
+    def __init__(self, project_fn=None, folders=None, line_count=100):
+        self._id = _next_id()
+        self._project_fn = project_fn
+        self._folders = folders if folders is not None else []
+        self._line_count = line_count
+        self._views = []
+        self._active = None
+        _windows.append(self)
+
+    def id(self):
+        api_calls['Window.id'] += 1
+        return self._id
+
+    def project_file_name(self):
+        api_calls['Window.project_file_name'] += 1
+        return self._project_fn
+
+    def folders(self):
+        api_calls['Window.folders'] += 1
+        return list(self._folders)
+
+    def views(self):
+        api_calls['Window.views'] += 1
+        return list(self._views)
+
+    def active_view(self):
+        api_calls['Window.active_view'] += 1
+        return self._active
+
+    def get_view_index(self, view):
+        api_calls['Window.get_view_index'] += 1
+        return (0, self._views.index(view))
+
+    def focus_view(self, view):
+        api_calls['Window.focus_view'] += 1
+        self._active = view
+
+    def find_open_file(self, fn):
+        api_calls['Window.find_open_file'] += 1
+        for view in self._views:
+            if view._fn == fn:
+                return view
+        return None
+
+    def open_file(self, fn, flags=0, group=-1):
+        ''' Opens with made up text. Use View.set_lines() for real text. '''
+        api_calls['Window.open_file'] += 1
+        view = self.find_open_file(fn)
+        if view is None:
+            view = View(self, fn, line_count=self._line_count)
+            view._loading = True
+            self._views.append(view)
+            set_timeout(lambda: self._finish_load(view))
+        self._active = view
+        return view
+
+    def _finish_load(self, view):
+        ''' Loading completes on the next run_timeouts(). '''
+        import sublime_plugin
+        view._loading = False
+        sublime_plugin.dispatch('on_load', view)
+
+    def new_file(self):
+        api_calls['Window.new_file'] += 1
+        view = View(self, line_count=0)
+        self._views.append(view)
+        return view
+
+    def show_quick_panel(self, items, on_select, *args, **kwargs):
+        api_calls['Window.show_quick_panel'] += 1
+        self.quick_panel = (items, on_select)
+
+    def extract_variables(self):
+        return {}
@@ -0,0 +1,40 @@
+''' Stand-in for the ST sublime_plugin module so the plugin can run headless. '''
+
+
+# Instantiated listeners get the events.
+_listeners = []
+
+
+#-----------------------------------------------------------------------------------
+def dispatch(event, *args):
+    ''' Bench only. Call event on all listeners that have it. '''
+    for listener in _listeners:
+        func = getattr(listener, event, None)
+        if func is not None:
+            func(*args)
+
+
+#-----------------------------------------------------------------------------------
+class EventListener():
+
+    def __init__(self):
+        _listeners.append(self)
+
+
+#-----------------------------------------------------------------------------------
+class TextCommand():
+
+    def __init__(self, view):
+        self.view = view
+
+
+#-----------------------------------------------------------------------------------
+class WindowCommand():
+
+    def __init__(self, window):
+        self.window = window
+
+
+#-----------------------------------------------------------------------------------
+class ApplicationCommand():
+    pass
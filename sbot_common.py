@@ -4,12 +4,17 @@ import traceback
 import collections
 import datetime
 import pathlib
-import shutil
+import queue
+import threading
+import time
 import subprocess
 import sublime
 import sublime_plugin
 
 
+# Plugins using wait_load_file() must call load_done() from their on_load(), and load_done(view, cancel=True) from
+# their on_close(). That is what positions the view once it's loaded - there is no polling.
+
 # This will get replaced with a plugin specific name during the copy process.
 _plugin_name = 'SignetBookmarks'
 
@@ -19,6 +24,13 @@ HighlightInfo = collections.namedtuple('HighlightInfo', 'scope_name, region_name
 # Track temporary view.
 _temp_view_id = None
 
+# Settings are loaded once then values are cached until they change.
+_settings_obj = None
+_settings_cache = {}
+
+# Views opened by wait_load_file() that are still loading, and the line to go to.
+_load_waiters = {}
+
 # Plugin data storage dir.
 _store_path = os.path.join(sublime.packages_path(), 'User', _plugin_name)
 pathlib.Path(_store_path).mkdir(parents=True, exist_ok=True)
@@ -47,6 +59,48 @@ def get_settings_fn():
     return os.path.join(f'{_plugin_name}.sublime-settings')
 
 
+#-----------------------------------------------------------------------------------
+def init_settings():
+    '''Load the settings once and drop cached values when they change. Call from plugin_loaded().'''
+    global _settings_obj
+    _settings_obj = sublime.load_settings(get_settings_fn())
+    _settings_obj.clear_on_change(_plugin_name)
+    _settings_obj.add_on_change(_plugin_name, _settings_cache.clear)
+    _settings_cache.clear()
+
+
+#-----------------------------------------------------------------------------------
+def get_setting(name, default=None):
+    '''Get a setting value from the cache. Returns default if not set.'''
+    if name not in _settings_cache:
+        if _settings_obj is None:
+            init_settings()
+        _settings_cache[name] = _settings_obj.get(name)  # pyright: ignore
+    val = _settings_cache[name]
+    return default if val is None else val
+
+
+#-----------------------------------------------------------------------------------
+def get_bool_setting(name, default=False):
+    '''Get a setting as bool.'''
+    return bool(get_setting(name, default))
+
+
+#-----------------------------------------------------------------------------------
+def get_int_setting(name, default=0):
+    '''Get a setting as int. Returns default if not a number.'''
+    try:
+        return int(get_setting(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+#-----------------------------------------------------------------------------------
+def get_str_setting(name, default=''):
+    '''Get a setting as str.'''
+    return str(get_setting(name, default))
+
+
 #-----------------------------------------------------------------------------------
 def get_single_caret(view):
     '''Get current caret position for one only region. If multiples, return None.'''
@@ -101,19 +155,18 @@ def create_new_view(window, text, reuse=True):
 
 #-----------------------------------------------------------------------------------
 def wait_load_file(window, fpath, line):
-    '''Open file asynchronously then position at line. Returns the new View or None if failed.'''
+    '''Open file asynchronously then position at line. Returns the new View or None if failed.
+    The plugin must call load_done() from its on_load() to finish the job.'''
     vnew = None
 
-    def _load(view):
-        if view.is_loading():
-            sublime.set_timeout(lambda: _load(view), 10)  # maybe not forever?
-        else:
-            view.run_command("goto_line", {"line": line})
-
     # Open the file in a new view.
     try:
         vnew = window.open_file(fpath)
-        _load(vnew)
+        if vnew.is_loading():
+            _load_waiters[vnew.id()] = line
+        else:
+            _load_waiters.pop(vnew.id(), None)
+            vnew.run_command("goto_line", {"line": line})
     except Exception as e:
         error(f'Failed to open {fpath}: {e}', e.__traceback__)
         vnew = None
@@ -121,6 +174,14 @@ def wait_load_file(window, fpath, line):
     return vnew
 
 
+#-----------------------------------------------------------------------------------
+def load_done(view, cancel=False):
+    '''Call from on_load(). Positions a view opened by wait_load_file(). Call with cancel from on_close().'''
+    line = _load_waiters.pop(view.id(), None)
+    if line is not None and not cancel:
+        view.run_command("goto_line", {"line": line})
+
+
 #-----------------------------------------------------------------------------------
 def get_highlight_info(which='all'):
     '''Get list of builtin scope names and corresponding region names as list of HighlightInfo.'''
@@ -239,15 +300,36 @@ def open_terminal(where):
 # Local log file.
 _log_fn = os.path.join(_store_path, f'{_plugin_name}.log')
 
+# Roll over the log when it gets bigger than this.
+_log_max_size = 50000
+
+# Levels in increasing order.
+LOG_LEVELS = ['DBG', 'INF', 'WRN', 'ERR']
+
+# Messages below this level are dropped.
+_log_level = 'DBG'
+
+# Only messages at or above this level get the caller file:line. Getting the frame isn't free.
+_log_caller_level = 'WRN'
+
+# Records waiting for the log writer thread. Items are (level, message, time, caller, tb).
+_log_queue = queue.Queue()
+_log_thread = None
+
 
 #-----------------------------------------------------------------------------------
-# Initialize logging. Maybe roll over log now.
-if os.path.exists(_log_fn) and os.path.getsize(_log_fn) > 50000:
-    bup = _log_fn.replace('.log', '_old.log')
-    shutil.copyfile(_log_fn, bup)
-    # Clear current log file.
-    with open(_log_fn, 'w'):
-        pass
+def set_log_level(level, caller_level=None):
+    '''Set the minimum level that gets logged and optionally the minimum that gets caller info.'''
+    global _log_level, _log_caller_level
+    _log_level = level
+    if caller_level is not None:
+        _log_caller_level = caller_level
+
+
+#-----------------------------------------------------------------------------------
+def flush_log():
+    '''Wait until everything logged so far is in the file. Call from plugin_unloaded().'''
+    _log_queue.join()
 
 
 #-----------------------------------------------------------------------------------
@@ -286,10 +368,8 @@ def debug(message):
 
 #-----------------------------------------------------------------------------------
 def _write_log(level, message, tb=None):
-    '''Format a standard message with caller info and log it.'''
-
-    # if _log_fn == INVALID_FN:
-    #     raise RuntimeError('Logger has not been initialized.')
+    '''Queue a standard message for the log writer. Formatting and file access happen there.'''
+    global _log_thread
 
     # Sometimes get stray empty lines.
     if len(message) == 0:
@@ -297,27 +377,63 @@ def _write_log(level, message, tb=None):
     if len(message) == 1 and message[0] == '\n':
         return
 
-    # Get caller info.
-    frame = sys._getframe(2)
-    fn = os.path.basename(frame.f_code.co_filename)
-    line = frame.f_lineno
-    # f'func = {frame.f_code.co_name}'
-    # f'mod_name = {frame.f_globals["__name__"]}'
-    # f'class_name = {frame.f_locals["self"].__class__.__name__}'
+    if LOG_LEVELS.index(level) < LOG_LEVELS.index(_log_level):
+        return
 
-    time_str = f'{str(datetime.datetime.now())}'[0:-3]
+    # Get caller info. Just grab the bits needed, make them pretty later.
+    caller = None
+    if LOG_LEVELS.index(level) >= LOG_LEVELS.index(_log_caller_level):
+        frame = sys._getframe(2)
+        caller = (frame.f_code.co_filename, frame.f_lineno)
+        # f'func = {frame.f_code.co_name}'
+        # f'mod_name = {frame.f_globals["__name__"]}'
+        # f'class_name = {frame.f_locals["self"].__class__.__name__}'
 
-    # Write the record. No need to be synchronized across multiple sbot plugins
-    # as ST docs say that API runs on a single thread.
-    with open(_log_fn, 'a') as log:
-        out_line = f'{time_str} {level} {fn}:{line} {message}'
-        log.write(out_line + '\n')
+    if _log_thread is None:
+        _log_thread = threading.Thread(target=_run_log_writer, daemon=True)
+        _log_thread.start()
+
+    _log_queue.put((level, message, time.time(), caller, tb))
+
+
+#-----------------------------------------------------------------------------------
+def _run_log_writer():
+    '''Log writer thread. Writes whatever has piled up in one go.'''
+    while True:
+        recs = [_log_queue.get()]
+        while True:
+            try:
+                recs.append(_log_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        try:
+            _write_log_recs(recs)
+        except Exception:
+            pass  # Nowhere to report it.
+        finally:
+            for _ in recs:
+                _log_queue.task_done()
+
+
+#-----------------------------------------------------------------------------------
+def _write_log_recs(recs):
+    '''Log writer thread. Format and write the records. Roll over the log by renaming it when it gets big.'''
+    out_lines = []
+    for level, message, tm, caller, tb in recs:
+        time_str = f'{str(datetime.datetime.fromtimestamp(tm))}'[0:-3]
+        where = f' {os.path.basename(caller[0])}:{caller[1]}' if caller is not None else ''
+        out_lines.append(f'{time_str} {level}{where} {message}')
         if tb is not None:
             # The traceback formatter is a bit ugly - clean it up.
-            tblines = []
             for s in traceback.format_tb(tb):
                 if len(s) > 0:
-                    tblines.append(s[:-1])
-            stb = '\n'.join(tblines)
-            log.write(stb + '\n')
-        log.flush()
+                    out_lines.append(s[:-1])
+
+    # No need to be synchronized across multiple sbot plugins as each has its own log file.
+    with open(_log_fn, 'a') as log:
+        log.write('\n'.join(out_lines) + '\n')
+        size = log.tell()
+
+    if size > _log_max_size:
+        os.replace(_log_fn, _log_fn.replace('.log', '_old.log'))
@@ -1,9 +1,17 @@
-import sys
 import os
-import json
+import re
+import mmap
+import bisect
+import time
+import threading
+import itertools
+import functools
+import collections
+from array import array
 import sublime
 import sublime_plugin
 from . import sbot_common as sc
+from .signet_store import SignetStore, PathResolver, make_rows, make_fps, line_fp, find_lines, scan_files, walk_folders
 
 
 # TODO Allow signets for temp/scratch files. Not persisted until saved w/filename.
@@ -13,25 +21,176 @@ from . import sbot_common as sc
 SIGNET_REGION_NAME = 'signet_region'
 SIGNET_ICON = 'Packages/Theme - Default/common/label.png'
 
-# The current signets. This is global across all ST instances/window/projects.
-# See Packages/User/SignetBookmarks/SignetBookmarks.store
-_sigs = {}
+# Canonical paths for the store and view index keys. Only for comparing - show and open real_path() of them.
+# Cleared when project folders change.
+_paths = PathResolver()
 
+# The current signets and their persistence. This is global across all windows/projects and shared safely with
+# other ST instances. See Packages/User/SignetBookmarks/shards/*.store
+_store = SignetStore(os.path.dirname(sc.get_store_fn()), os.path.splitext(os.path.basename(sc.get_store_fn()))[0],
+                     post=sublime.set_timeout, run_async=sublime.set_timeout_async, call_later=sublime.set_timeout,
+                     on_error=lambda message, tb: sc.error(message, tb),
+                     on_changed=lambda proj_fn, fn, rows, foreign: _on_store_changed(proj_fn, fn, rows, foreign),
+                     resolve_path=_paths.resolve)
+
+# More than this in the select panel and it asks for the file first.
+PANEL_MAX_ITEMS = 5000
+
+# Select panel items per file, made when first needed. Key is project_fn, value is dict of fn to (items, rows).
+_panel_items = {}
+
+# Max line index cache entries and preview length.
+LINE_INDEX_MAX = 500
+PREVIEW_LEN = 200
+
+# Line start offsets for files on disk, for previews. Key is fn, value is (mtime, size, offsets). Least recently used first.
+_line_index = collections.OrderedDict()
+
+# Files having their line index built in the background.
+_line_index_pending = set()
+
+# Max views tracked in _view_states that aren't in the window index. Closed views are dropped right away so this is
+# only a backstop. Indexed views don't count as they are dropped when closed.
+VIEW_STATES_MAX = 2000
+
+# What is known about each view. Key is view id, value is _ViewState. Least recently used first.
+_view_states = collections.OrderedDict()
+
+# Open file views per window so navigation doesn't walk the tabs. Key is window id, value is {fn: [(view id, view)]}.
+# Kept up to date from the view events.
+_win_views = {}
+
+# Open views of each file across all windows, so a change repaints just the views it affects.
+# Key is fn, value is [(view id, view)]. Kept with _win_views.
+_file_views = {}
+
+# Window commands that change the project folders.
+FOLDER_COMMANDS = {'prompt_add_folder', 'remove_folder', 'refresh_folder_list', 'close_folder_list', 'prompt_open_folder'}
+
+# Pattern scan results are handed to the UI at most this often, sec.
+SCAN_BATCH_TIME = 0.2
+
+# Bumped for each pattern scan so a newer one stops an older one.
+_scan_id = 0
+
+# Upper bounds of the latency histogram buckets, msec. Last one catches the rest.
+STATS_BUCKETS = [0.1, 0.5, 1, 5, 10, 50, 100, 500]
+
+# Instrumentation results when enabled by the instrument setting. Key is handler name, value is _Stats.
+_stats = {}
 
 
 #-----------------------------------------------------------------------------------
 def plugin_loaded():
     '''Called per plugin instance.'''
-    pass
+    sc.init_settings()
+
+
+#-----------------------------------------------------------------------------------
+def plugin_unloaded():
+    '''Called per plugin instance. Don't lose anything waiting for autosave or logging.'''
+    _store.save(wait=True)
+    sc.flush_log()
+
+
+#-----------------------------------------------------------------------------------
+class _Stats():
+    ''' Latency histogram and API call counts for one handler. '''
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.hist = [0] * (len(STATS_BUCKETS) + 1)
+        self.api = collections.Counter()
+
+    def add(self, msec):
+        self.calls += 1
+        self.total += msec
+        self.max = max(self.max, msec)
+        self.hist[bisect.bisect_left(STATS_BUCKETS, msec)] += 1
+
+
+#-----------------------------------------------------------------------------------
+class _Counted():
+    ''' Stands in for a View or Window and counts the API calls made through it. Anything
+    View or Window it returns is wrapped too. Only used when instrumenting. '''
+
+    def __init__(self, target, api):
+        self._target = target
+        self._api = api
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+        key = f'{type(self._target).__name__}.{name}'
+
+        def _call(*args, **kwargs):
+            self._api[key] += 1
+            return _count_api(attr(*args, **kwargs), self._api)
+        return _call
+
+    def __eq__(self, other):
+        return self._target == (other._target if isinstance(other, _Counted) else other)
+
+    def __hash__(self):
+        return hash(self._target)
+
+
+#-----------------------------------------------------------------------------------
+def _count_api(obj, api):
+    ''' Wrap obj in _Counted if it's a View or Window, or a list of them. '''
+    if isinstance(obj, (sublime.View, sublime.Window)):
+        return _Counted(obj, api)
+    if isinstance(obj, list) and len(obj) > 0 and isinstance(obj[0], (sublime.View, sublime.Window)):
+        return [_Counted(o, api) for o in obj]
+    return obj
+
+
+#-----------------------------------------------------------------------------------
+def _uncounted(obj):
+    ''' The real View or Window if obj is wrapped in _Counted. Anything kept past the handler call must be
+    the real one or its calls get counted to that handler forever. '''
+    return obj._target if isinstance(obj, _Counted) else obj
+
+
+#-----------------------------------------------------------------------------------
+def _instrumented(func):
+    ''' Decorator for event handlers and command run(). When the instrument setting is on, records
+    the latency and the API calls made through the View/Window args or the command view. '''
+    name = func.__qualname__
+
+    @functools.wraps(func)
+    def _wrapper(self, *args, **kwargs):
+        if not sc.get_bool_setting('instrument'):
+            return func(self, *args, **kwargs)  # --- the normal way
+
+        stats = _stats.setdefault(name, _Stats())
+        args = [_count_api(a, stats.api) for a in args]
+        view = getattr(self, 'view', None)
+        if view is not None:
+            self.view = _Counted(view, stats.api)
+
+        start = time.perf_counter()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            stats.add((time.perf_counter() - start) * 1000)
+            if view is not None:
+                self.view = view
+
+    return _wrapper
 
 
 #-----------------------------------------------------------------------------------
 class SignetEvent(sublime_plugin.EventListener):
     ''' Listener for view specific events of interest. '''
 
-    # Need to track what's been initialized.
-    _views_inited = set()
+    # How many collections were done or skipped because the view hadn't changed.
+    collect_counts = {'performed': 0, 'skipped': 0}
 
+    @_instrumented
     def on_init(self, views):
         ''' First thing that happens when plugin/window created. Load the persistence file. Views are valid.
         Note that this also happens if this module is reloaded - like when editing this file. '''
@@ -42,32 +201,67 @@ class SignetEvent(sublime_plugin.EventListener):
                 project_fn = win.project_file_name()
                 self._read_store()
                 for view in views:
+                    _register_view(view)
                     self._init_view(view)
 
     def on_load_project(self, window):
         ''' This gets called for new windows but not for the first one. '''
+        _paths.clear()
         for view in window.views():
+            _register_view(view)
             self._init_view(view)
 
+    @_instrumented
     def on_pre_close_project(self, window):
         ''' Save to file when closing window/project. '''
         self._write_store()
 
+    @_instrumented
     def on_load(self, view):
         ''' Load a new file. '''
+        _register_view(view)
         self._init_view(view)
+        sc.load_done(view)
+
+    def on_new(self, view):
+        ''' New view. It's only tracked once it has a file name. '''
+        _register_view(view)
+
+    def on_activated(self, view):
+        ''' May have been moved to another window or saved as a new name. '''
+        _register_view(view)
+
+    def on_post_save(self, view):
+        ''' May have been saved as a new name. '''
+        _register_view(view)
+
+    def on_post_window_command(self, window, command_name, args):
+        ''' Project folders changed so paths may resolve differently. '''
+        del window, args
+        if command_name in FOLDER_COMMANDS:
+            _paths.clear()
+
+    def on_close(self, view):
+        ''' View is gone. '''
+        _drop_view_state(view.id())
+        sc.load_done(view, cancel=True)
+
+    def on_reload(self, view):
+        ''' File changed elsewhere - find where the signets went. '''
+        self._apply_sigs(view)
 
     # def on_pre_close(self, view):
     #     ''' This happens after on_pre_close_project(). Get the current sigs for the view. '''
     #     self._collect_sigs(view)
 
+    @_instrumented
     def on_deactivated(self, view):
         ''' This happens after view loses focus. Get the current sigs for the view. '''
         self._collect_sigs(view)
 
     def _init_view(self, view):
         ''' Lazy init. '''
-        fn = view.file_name()
+        fn = _get_view_fn(view)
         if view.is_scratch() is True or fn is None:
             return
 
@@ -76,151 +270,163 @@ class SignetEvent(sublime_plugin.EventListener):
             return
 
         # Init the view if not already.
-        vid = view.id()
-        if vid not in self._views_inited:
-            self._views_inited.add(vid)
-
-            # Init the view with any persisted values.
-            rows = None  # Default
-            winid = view.window().id()
-            fn = view.file_name()
-
-            if fn in project_sigs:
-                rows = project_sigs[fn]
-
-            if rows is not None:
-                # Update visual signets, brutally. This is the ST way.
-                regions = []
-                for r in rows:
-                    pt = view.text_point(r - 1, 0)  # ST is 0-based
-                    regions.append(sublime.Region(pt, pt))
-                settings = sublime.load_settings(sc.get_settings_fn())
-                view.add_regions(SIGNET_REGION_NAME, regions, settings.get('scope'), SIGNET_ICON)
+        state = _get_view_state(view.id())
+        if not state.inited:
+            state.inited = True
+            self._apply_sigs(view)
+
+    def _apply_sigs(self, view):
+        ''' Init the view with any persisted values. The file may have changed since they were saved
+        so check the fingerprints and relocate if needed. '''
+        fn = _get_view_fn(view)
+        win = view.window()
+        project_sigs = _get_project_sigs(view, init=False)
+        if project_sigs is None or fn not in project_sigs:
+            return
+
+        proj_fn = _get_proj_fn(win)
+        if any(_store.get_fps(proj_fn, fn)):
+            lost = _store.relocate(proj_fn, fn, _get_view_lines(view))
+            if lost > 0:
+                sc.info(f'{lost} signets in {os.path.basename(_paths.real_path(fn))} could not be relocated')
+        rows = _store.get_rows(proj_fn, fn)
+
+        _set_view_signet_rows(view, array('I', (r - 1 for r in rows)))  # ST is 0-based
+        # Persisted rows may be past the end of a file changed elsewhere so let the view sort it out.
+        _get_view_state(view.id()).rows = None
 
     def _read_store(self):
-        ''' General project opener. Cleans up bad entries '''
-        global _sigs
-
-        store_fn = sc.get_store_fn()
-        if os.path.isfile(store_fn):
-            try:
-                with open(store_fn, 'r') as fp:
-                    _temp_sigs = json.load(fp)
-                    # Sanity checks. Easier to make a new clean collection rather than remove parts.
-                    _sigs.clear()
-
-                    for proj_fn, proj_sigs in _temp_sigs.items():
-                        if os.path.exists(proj_fn):
-                            files = {}
-                            for fn, lines in _temp_sigs[proj_fn].items():
-                                if os.path.exists(fn) and len(lines) > 0:
-                                    files[fn] = lines
-                            if len(files) > 0:
-                                _sigs[proj_fn] = files
-
-            except Exception as e:
-                sc.error(f'Error reading {store_fn}: {e}', e.__traceback__)
-
-        else:  # Assume new file with default fields.
+        ''' General project opener. Projects are loaded on demand. '''
+        _store.store_format = _get_store_format()
+        _panel_items.clear()
+        if not _store.read():
             sublime.status_message('Creating new signets file')
-            _sigs = {}
 
     def _write_store(self):  #, window):
-        ''' Save everything. '''
-        global _sigs
-
-        store_fn = sc.get_store_fn()
-
-        try:
-            with open(store_fn, 'w') as fp:
-                json.dump(_sigs, fp, indent=4)
-        except Exception as e:
-            sc.error(f'Error writing {store_fn}: {e}', e.__traceback__)
+        ''' Save anything that moved during editing and wait for it to get to disk. '''
+        sc.debug(f'Collections performed:{self.collect_counts["performed"]} skipped:{self.collect_counts["skipped"]}')
+        _store.save(wait=True)
 
     def _collect_sigs(self, view):
         ''' Update the signets from the view as they may have moved during editing. '''
 
-        fn = view.file_name()
+        fn = _get_view_fn(view)
         window = view.window()
 
         project_sigs = _get_project_sigs(view, init=False)
 
         if project_sigs is not None:
+            # No signets in a view that hasn't been given them yet doesn't mean they were all removed.
+            state = _get_view_state(view.id())
+            if view.is_loading() or not state.inited:
+                return  # --- early return
+
             regions = view.get_regions(SIGNET_REGION_NAME)
 
-            if len(regions) > 0:
-                if fn in project_sigs:
-                    project_sigs[fn].clear()
-                else:
-                    project_sigs[fn] = []
+            # Nothing can have moved if the view hasn't been edited and no signets were added or removed.
+            collected = (view.change_count(), len(regions))
+            if state.collected == collected:
+                self.collect_counts['skipped'] += 1
+                return
+            state.collected = collected
+            self.collect_counts['performed'] += 1
 
-                for reg in regions:
-                    row, _ = view.rowcol(reg.a)
-                    project_sigs[fn].append(row + 1)
-            else:
-                try:
-                    project_sigs.delete(fn)
-                except:
-                    pass
+            rows = [view.rowcol(reg.a)[0] + 1 for reg in regions]
+            fps = []
+            if len(rows) > 0:
+                lines = _get_view_lines(view)
+                fps = [line_fp(lines[r - 1]) for r in rows]
+
+            # Only real changes are noted so the journal doesn't fill up with noise.
+            _store.set_rows(_get_proj_fn(window), fn, *make_fps(rows, fps))
 
 
 #-----------------------------------------------------------------------------------
 class SbotToggleSignetCommand(sublime_plugin.TextCommand):
-    ''' Flip the signet. '''
+    ''' Flip the signet on every selected row. '''
 
     def is_visible(self):
         # Don't allow signets in temp views.
         return self.view.is_scratch() is False and self.view.file_name() is not None
 
+    @_instrumented
     def run(self, edit):
         del edit
 
         view = self.view
         win = view.window()
-        fn = view.file_name()
+        fn = _get_view_fn(view)
 
         # Don't allow signets in temp views.
-        if view.is_scratch() is True or view.file_name() is None:
+        if view.is_scratch() is True or fn is None:
             return
 
-        # Get current selected row.
-        caret = sc.get_single_caret(view)
-        if caret is None:
+        # Get the rows of all carets and selections. A single caret is the usual case and needs one call,
+        # otherwise work from the text rather than asking the view about each one.
+        sel = list(view.sel())
+        lines = None
+        if len(sel) == 0:
             return  # -- early return
-
-        sel_row, _ = view.rowcol(caret)
-        sig_rows = _get_view_signet_rows(view)
-
-        if sel_row != -1:
-            # Do the toggle. Is there one currently at the selected row?
-            existing = sel_row in sig_rows
-            if existing:
-                sig_rows.remove(sel_row)
-            else:
-                sig_rows.append(sel_row)
+        if len(sel) == 1 and sel[0].a == sel[0].b:
+            sel_rows = {view.rowcol(sel[0].a)[0]}
+        else:
+            lines, starts = _get_view_line_starts(view)
+            sel_rows = _get_sel_rows(sel, starts)
 
         # Update collection.
         project_sigs = _get_project_sigs(view)
+        if project_sigs is None:
+            return  # -- early return
 
-        if project_sigs is not None:
-            project_sigs[fn] = sig_rows
-
-            # Update visual signets, brutally. This is the ST way.
-            regions = []
-            for r in sig_rows:
-                pt = view.text_point(r, 0)  # 0-based
-                regions.append(sublime.Region(pt, pt))
+        proj_fn = _get_proj_fn(win)
+        sig_rows = _get_view_signet_rows(view)
 
-            settings = sublime.load_settings(sc.get_settings_fn())
-            view.add_regions(SIGNET_REGION_NAME, regions, str(settings.get('scope')), SIGNET_ICON)
+        # Reuse the existing regions rather than making them all again. If some have collapsed onto one row, start over.
+        regions = view.get_regions(SIGNET_REGION_NAME)
+        row_regions = dict(zip(sig_rows, regions)) if len(regions) == len(sig_rows) else {}
+
+        # Keep the fingerprints of the other signets. Any that moved get fixed up when collected.
+        old_fps = dict(zip(_store.get_rows(proj_fn, fn), _store.get_fps(proj_fn, fn)))
+
+        # Do the toggle. Selected rows with a signet lose it, the others get one.
+        new_rows = set(sig_rows).symmetric_difference(sel_rows)
+        added = new_rows.intersection(sel_rows)
+        if len(added) == 1 and lines is None:
+            r = next(iter(added))
+            pt = view.text_point(r, 0)
+            row_regions[r] = sublime.Region(pt, pt)
+            old_fps[r + 1] = line_fp(view.substr(view.line(pt)))
+        elif len(added) > 0:
+            if lines is None:
+                lines, starts = _get_view_line_starts(view)
+            for r in added:
+                if r < len(lines):
+                    row_regions[r] = sublime.Region(starts[r], starts[r])
+                    old_fps[r + 1] = line_fp(lines[r])
+
+        sig_rows = make_rows(new_rows)
+        regions = [row_regions.get(r) for r in sig_rows]
+        if any(reg is None for reg in regions):
+            regions = None
+
+        rows = array('I', (r + 1 for r in sig_rows))  # Store is 1-based.
+        _store.set_rows(proj_fn, fn, rows, array('I', (old_fps.get(r, 0) for r in rows)))
+
+        # This view and any clones or views in other windows.
+        _show_file_signets(proj_fn, fn, sig_rows, regions)
 
 
 #-----------------------------------------------------------------------------------
 class SbotGotoSignetCommand(sublime_plugin.TextCommand):
     ''' Navigate to next/previous/select signet in whole collection. '''
 
-    panel_items = []
+    # What the select panel items refer to. List of (fn, line).
+    panel_targets = []
+
+    # What the file panel items refer to when there are too many signets for one panel.
+    panel_files = []
 
+    @_instrumented
     def run(self, edit, where):
         # Common navigate to signet in whole collection.
         del edit
@@ -236,14 +442,17 @@ class SbotGotoSignetCommand(sublime_plugin.TextCommand):
 
         ### What kind of request?
         if where == 'sel': # user select specific signet
-            self.panel_items.clear()
+            proj_fn = _get_proj_fn(win)
+            sig_files = _store.get_files(proj_fn)
 
-            for fn, lines in project_sigs.items():
-                for line in lines:
-                    self.panel_items.append(sublime.QuickPanelItem(trigger=f'{fn} line:{line}', kind=sublime.KIND_AMBIGUOUS))
-            win = self.view.window()
-            if win is not None:
-                win.show_quick_panel(self.panel_items, on_select=self.on_sel_sig)
+            if sum(len(project_sigs[fn]) for fn in sig_files) <= PANEL_MAX_ITEMS:
+                self._show_sigs_panel(proj_fn, sig_files)
+            else:
+                # Too many to be useful. Pick the file first.
+                self.panel_files = list(sig_files)
+                items = [sublime.QuickPanelItem(trigger=_paths.real_path(fn), annotation=f'{len(project_sigs[fn])} signets', kind=sublime.KIND_AMBIGUOUS)
+                         for fn in self.panel_files]
+                win.show_quick_panel(items, on_select=self.on_sel_file)
 
         else:
             caret = sc.get_single_caret(view)
@@ -252,11 +461,9 @@ class SbotGotoSignetCommand(sublime_plugin.TextCommand):
 
             next = where == 'next'
 
-            settings = sublime.load_settings(sc.get_settings_fn())
-            nav_all_files = settings.get('nav_all_files')
+            nav_all_files = sc.get_bool_setting('nav_all_files')
 
             sel_row, _ = view.rowcol(caret)  # current selected row
-            incr = +1 if next else -1
             array_end = 0 if next else -1
 
             done = False
@@ -265,72 +472,80 @@ class SbotGotoSignetCommand(sublime_plugin.TextCommand):
             # 1) prev: If there's another bookmark above -> goto it
             if not done:
                 sig_rows = _get_view_signet_rows(view)
-                if not next:
-                    sig_rows.reverse()
-                for sr in sig_rows:
-                    if (next and sr > sel_row) or (not next and sr < sel_row):
-                        view.run_command("goto_line", {"line": sr + 1})
-                        done = True
-                        break
+                if next:
+                    i = bisect.bisect_right(sig_rows, sel_row)
+                else:
+                    i = bisect.bisect_left(sig_rows, sel_row) - 1
+                if 0 <= i < len(sig_rows):
+                    view.run_command("goto_line", {"line": sig_rows[i] + 1})
+                    done = True
 
                 # At begin or end. Check for single file operation.
                 if not done and not nav_all_files and len(sig_rows) > 0:
-                    view.run_command("goto_line", {"line": sig_rows[0] + 1})
+                    view.run_command("goto_line", {"line": sig_rows[array_end] + 1})
                     done = True
 
-            # 2) next: Else if there's an open signet file to the right of this tab -> focus tab, goto first signet
-            # 2) prev: Else if there's an open signet file to the left of this tab -> focus tab, goto last signet
+            # 2) next: Else -> the next file with signets in the project, open it if needed, goto first signet
+            # 2) prev: Else -> the previous file with signets in the project, open it if needed, goto last signet
+            # Files are in path order and it wraps around, back to this file if it is the only one.
             if not done:
-                view_index = win.get_view_index(view)[1] + incr
-                while not done and ((next and view_index < len(win.views()) or (not next and view_index >= 0))):
-                    vv = win.views()[view_index]
-                    sig_rows = _get_view_signet_rows(vv)
-                    if len(sig_rows) > 0:
-                        win.focus_view(vv)
-                        vv.run_command("goto_line", {"line": sig_rows[array_end] + 1})
+                proj_fn = _get_proj_fn(win)
+                targets = _store.iter_files(proj_fn, _get_view_fn(view) or '', next)
+
+                for target_fn in targets:
+                    vv = _find_open_file(win, target_fn)
+                    if vv is not None:
+                        sig_rows = _get_view_signet_rows(vv)
+                        if len(sig_rows) > 0:
+                            win.focus_view(vv)
+                            vv.run_command("goto_line", {"line": sig_rows[array_end] + 1})
+                            done = True
+                    elif os.path.exists(target_fn):
+                        rows = project_sigs[target_fn]
+                        sc.wait_load_file(win, _paths.real_path(target_fn), rows[array_end])
                         done = True
-                    else:
-                        view_index += incr
 
-            # 3) next: Else if there is a signet file in the project that is not open -> open it, focus tab, goto first signet
-            # 3) prev: Else if there is a signet file in the project that is not open -> open it, focus tab, goto last signet
-            if not done:
-                for fn, rows in project_sigs.items():
-                    if fn is not None:
-                        if win.find_open_file(fn) is None and os.path.exists(fn) and len(rows) > 0:
-                            vv = sc.wait_load_file(win, fn, rows[array_end])
-                            done = True
-                            break
+                    if done:
+                        break
 
-            # 4) next: Else -> find first tab/file with signets, focus tab, goto first signet
-            # 4) prev: Else -> find last tab/file with signets, focus tab, goto last signet
-            if not done:
-                view_index = 0 if next else len(win.views()) - 1
-                while not done and ((next and view_index < len(win.views()) or (not next and view_index >= 0))):
-                    vv = win.views()[view_index]
-                    sig_rows = _get_view_signet_rows(vv)
-                    if len(sig_rows) > 0:
-                        win.focus_view(vv)
-                        vv.run_command("goto_line", {"line": sig_rows[array_end] + 1})
-                        done = True
-                    else:
-                        view_index += incr
+                # Get the one after that ready.
+                if done and sc.get_bool_setting('prefetch'):
+                    for target_fn in targets:
+                        if _find_open_file(win, target_fn) is None:
+                            _prefetch_file(proj_fn, target_fn)
+                        break
+
+    def _show_sigs_panel(self, proj_fn, fns):
+        ''' Show the signets for the files in a panel. Items are made once per file and reused until its signets change. '''
+        items = []
+        self.panel_targets = []
+        for fn in fns:
+            file_items, rows = _get_panel_items(proj_fn, fn)
+            items.extend(file_items)
+            self.panel_targets.extend((fn, line) for line in rows)
+
+        win = self.view.window()
+        if win is not None:
+            win.show_quick_panel(items, on_select=self.on_sel_sig)
+
+    def on_sel_file(self, *args, **kwargs):
+        ''' User file selection when there are a lot of signets. '''
+        del kwargs
+        if len(args) > 0 and args[0] >= 0:
+            self._show_sigs_panel(_get_proj_fn(self.view.window()), [self.panel_files[args[0]]])
 
     def on_sel_sig(self, *args, **kwargs):
         ''' User signet selection. '''
         del kwargs
         if len(args) > 0 and args[0] >= 0:
-            fspec = self.panel_items[args[0]].trigger
-            parts = fspec.split('line:')
-            fn = parts[0].strip()
-            line = int(parts[1].strip())
+            fn, line = self.panel_targets[args[0]]
 
             # Open the file if not already.
             win = self.view.window()
 
-            vv = win.find_open_file(fn)
+            vv = _find_open_file(win, fn)
             if vv is None:
-                vv = sc.wait_load_file(win, fn, line)
+                vv = sc.wait_load_file(win, _paths.real_path(fn), line)
             win.focus_view(vv)
             vv.run_command("goto_line", {"line": line})
 
@@ -343,6 +558,7 @@ class SbotGotoSignetCommand(sublime_plugin.TextCommand):
 class SbotClearAllSignetsCommand(sublime_plugin.TextCommand):
     ''' Clear all signets in project. '''
 
+    @_instrumented
     def run(self, edit):
         del edit
 
@@ -351,22 +567,23 @@ class SbotClearAllSignetsCommand(sublime_plugin.TextCommand):
             return  # --- early return
 
         # Bam.
+        proj_fn = _get_proj_fn(self.view.window())
+        fns = list(_store.get_files(proj_fn))
         try:
-            del _sigs[self.view.window().project_file_name()]  # pyright: ignore
+            _store.clear_project(proj_fn)
         # except Exception as e:
         #     pass
         finally:
             # Clear visuals in open views.
-            win = self.view.window()
-            if win is not None:
-                for v in win.views():
-                    v.erase_regions(SIGNET_REGION_NAME)
+            for fn in fns:
+                _show_file_signets(proj_fn, fn, array('I'))
 
 
 #-----------------------------------------------------------------------------------
 class SbotClearFileSignetsCommand(sublime_plugin.TextCommand):
     ''' Clear signets in current file. '''
 
+    @_instrumented
     def run(self, edit):
         del edit
 
@@ -375,40 +592,496 @@ class SbotClearFileSignetsCommand(sublime_plugin.TextCommand):
             return  # --- early return
 
         # Bam.
+        proj_fn = _get_proj_fn(self.view.window())
+        fn = _get_view_fn(self.view)
         try:
-            del _sigs[self.view.window().project_file_name()][self.view.file_name()]  # pyright: ignore
+            _store.clear_file(proj_fn, fn)
         # except Exception as e:
         #     pass
         finally:
-            # Clear visuals in open views.
-            win = self.view.window()
-            if win is not None:
-                for v in win.views():
-                    v.erase_regions(SIGNET_REGION_NAME)
+            # Clear visuals in the views of this file.
+            _show_file_signets(proj_fn, fn, array('I'))
+
+
+#-----------------------------------------------------------------------------------
+class SbotSignetPatternCommand(sublime_plugin.TextCommand):
+    ''' Add signets to every line matching a regex, in this file or all the project folders. '''
+
+    def is_visible(self, where='project', pattern=None):
+        del pattern
+        win = self.view.window()
+        if win is None or win.project_file_name() is None:
+            return False
+        return where != 'file' or (self.view.is_scratch() is False and self.view.file_name() is not None)
+
+    @_instrumented
+    def run(self, edit, where='project', pattern=None):
+        del edit
+
+        view = self.view
+        win = view.window()
+        if win is None or win.project_file_name() is None:
+            return  # --- early return
+
+        if pattern is None:
+            # Ask then come back here.
+            win.show_input_panel('Signet lines matching:', '',
+                                 lambda text: view.run_command('sbot_signet_pattern', {'where': where, 'pattern': text}),
+                                 None, None)
+            return  # --- early return
+
+        if pattern == '':
+            return  # --- early return
+        try:
+            regex = re.compile(pattern)
+        except re.error as e:
+            sublime.status_message(f'Bad pattern: {e}')
+            return  # --- early return
+
+        _scan_pattern(win, view if where == 'file' else None, regex)
+
+
+#-----------------------------------------------------------------------------------
+class SbotSignetStatsCommand(sublime_plugin.TextCommand):
+    ''' Show the instrumentation results. '''
+
+    def run(self, edit):
+        del edit
+
+        win = self.view.window()
+        if win is None:
+            return  # --- early return
+
+        text = []
+        if not sc.get_bool_setting('instrument'):
+            text.append('Turn on the instrument setting to collect stats.')
+            text.append('')
+
+        buckets = [f'<{b}' for b in STATS_BUCKETS] + [f'>={STATS_BUCKETS[-1]}']
+        text.append(f'{"handler":<36} {"calls":>7} {"avg ms":>9} {"max ms":>9}  ' + ' '.join(f'{b:>6}' for b in buckets))
+        for name in sorted(_stats):
+            stats = _stats[name]
+            text.append(f'{name:<36} {stats.calls:>7} {stats.total / stats.calls:>9.3f} {stats.max:>9.3f}  ' +
+                        ' '.join(f'{h:>6}' for h in stats.hist))
+            if len(stats.api) > 0:
+                text.append('    api: ' + ', '.join(f'{k}:{v}' for k, v in stats.api.most_common()))
+
+        counts = SignetEvent.collect_counts
+        text.append('')
+        text.append(f'collections performed:{counts["performed"]} skipped:{counts["skipped"]}')
+
+        sc.create_new_view(win, '\n'.join(text) + '\n')
+
+
+#-----------------------------------------------------------------------------------
+def _get_sel_rows(sel, starts):
+    ''' The 0-based rows of the carets and selections in sel, as a set, from the line starts - see
+    _get_view_line_starts(). A selection that ends at the start of a line doesn't include that line. '''
+    rows = set()
+    for reg in sel:
+        first = bisect.bisect_right(starts, reg.begin()) - 1
+        last = bisect.bisect_right(starts, reg.end()) - 1
+        if last > first and starts[last] == reg.end():
+            last -= 1
+        rows.update(range(first, last + 1))
+    return rows
 
 
 #-----------------------------------------------------------------------------------
 def _get_view_signet_rows(view):
-    ''' Get all the signet row numbers in the view. Returns a sorted list. '''
-    sig_rows = []
-    for reg in view.get_regions(SIGNET_REGION_NAME):
-        row, _ = view.rowcol(reg.a)
-        sig_rows.append(row)
-    sig_rows.sort()
+    ''' Get all the signet row numbers in the view. Returns sorted rows which must only be modified
+    by passing them back to _set_view_signet_rows(). Cached until the view is edited. '''
+    change_count = view.change_count()
+    state = _get_view_state(view.id())
+    if state.rows is not None and state.rows[0] == change_count:
+        return state.rows[1]
+
+    sig_rows = make_rows(view.rowcol(reg.a)[0] for reg in view.get_regions(SIGNET_REGION_NAME))
+    state.rows = (change_count, sig_rows)
     return sig_rows
 
 
+#-----------------------------------------------------------------------------------
+def _set_view_signet_rows(view, sig_rows, regions=None):
+    ''' Update visual signets from sorted rows, brutally. This is the ST way. Regions can be supplied if already known. '''
+    if len(sig_rows) > 0:
+        if regions is None:
+            regions = []
+            for r in sig_rows:
+                pt = view.text_point(r, 0)  # 0-based
+                regions.append(sublime.Region(pt, pt))
+        view.add_regions(SIGNET_REGION_NAME, regions, sc.get_str_setting('scope'), SIGNET_ICON)
+    else:
+        view.erase_regions(SIGNET_REGION_NAME)
+    _get_view_state(view.id()).rows = (view.change_count(), sig_rows)
+
+
+#-----------------------------------------------------------------------------------
+class _ViewState():
+    ''' What is known about a view. '''
+    __slots__ = ('inited', 'collected', 'rows', 'where')
+
+    def __init__(self):
+        # Persisted signets have been applied.
+        self.inited = False
+        # (change_count, region count) when last collected.
+        self.collected = None
+        # (change_count, sorted 0-based rows) so navigation doesn't hit the view.
+        self.rows = None
+        # (window id, fn) in _win_views.
+        self.where = None
+
+
+#-----------------------------------------------------------------------------------
+def _get_view_state(vid):
+    ''' The state for a view, new if not known. If there are too many, the least recently used that aren't in the
+    window index are dropped - a live one that gets dropped is just inited again when next seen. Indexed ones are
+    left alone so they still get repainted and found. '''
+    state = _view_states.get(vid)
+    if state is None:
+        state = _ViewState()
+        _view_states[vid] = state
+        excess = len(_view_states) - VIEW_STATES_MAX
+        if excess > 0:
+            spare = [v for v, s in _view_states.items() if s.where is None and v != vid]
+            for v in spare[:excess]:
+                _drop_view_state(v)
+    else:
+        _view_states.move_to_end(vid)
+    return state
+
+
+#-----------------------------------------------------------------------------------
+def _drop_view_state(vid):
+    ''' Forget everything about a view. '''
+    state = _view_states.pop(vid, None)
+    if state is not None:
+        _unregister_view(vid, state)
+
+
+#-----------------------------------------------------------------------------------
+def _register_view(view):
+    ''' Note which window a file view is in. Safe to call again - only does something if it changed. '''
+    view = _uncounted(view)
+    vid = view.id()
+    fn = _get_view_fn(view)
+    win = view.window()
+    where = (win.id(), fn) if win is not None and fn is not None else None
+
+    state = _get_view_state(vid)
+    if state.where != where:
+        _unregister_view(vid, state)
+        if where is not None:
+            _win_views.setdefault(where[0], {}).setdefault(fn, []).append((vid, view))
+            _file_views.setdefault(fn, []).append((vid, view))
+            state.where = where
+
+
+#-----------------------------------------------------------------------------------
+def _unregister_view(vid, state):
+    ''' Take a view out of the window and file indexes. '''
+    where = state.where
+    state.where = None
+    if where is None:
+        return
+
+    win_views = _win_views.get(where[0], {})
+    entries = [e for e in win_views.get(where[1], []) if e[0] != vid]
+    if len(entries) > 0:
+        win_views[where[1]] = entries
+    else:
+        win_views.pop(where[1], None)
+        if len(win_views) == 0:
+            _win_views.pop(where[0], None)
+
+    entries = [e for e in _file_views.get(where[1], []) if e[0] != vid]
+    if len(entries) > 0:
+        _file_views[where[1]] = entries
+    else:
+        _file_views.pop(where[1], None)
+
+
+#-----------------------------------------------------------------------------------
+def _find_open_file(win, fn):
+    ''' Like window.find_open_file() but from the cache. '''
+    entries = _win_views.get(win.id(), {}).get(fn)
+    return entries[0][1] if entries is not None else None
+
+
+#-----------------------------------------------------------------------------------
+def _get_window_views(win):
+    ''' The open file views in the window, from the cache. '''
+    return [view for entries in _win_views.get(win.id(), {}).values() for _, view in entries]
+
+
+#-----------------------------------------------------------------------------------
+def _get_file_views(proj_fn, fn):
+    ''' The open views of a file in all the windows that have the project, from the cache. '''
+    views = []
+    for _, view in _file_views.get(fn, []):
+        win = view.window()
+        if win is not None and _get_proj_fn(win) == proj_fn:
+            views.append(view)
+    return views
+
+
+#-----------------------------------------------------------------------------------
+def _show_file_signets(proj_fn, fn, sig_rows, regions=None):
+    ''' Show sorted 0-based rows in every open view of a file in the project - one region update each.
+    Regions can be supplied if already known. '''
+    for view in _get_file_views(proj_fn, fn):
+        # Each gets its own copy as the view state keeps them.
+        _set_view_signet_rows(view, array('I', sig_rows), None if regions is None else list(regions))
+
+
+#-----------------------------------------------------------------------------------
+def _get_view_fn(view):
+    ''' Store key for the view file, None if it doesn't have one. '''
+    return _paths.resolve(view.file_name())
+
+
+#-----------------------------------------------------------------------------------
+def _get_proj_fn(win):
+    ''' Store key for the window project, None if it doesn't have one. '''
+    return _paths.resolve(win.project_file_name())
+
+
 #-----------------------------------------------------------------------------------
 def _get_project_sigs(view, init=True):
     ''' Get the signets associated with this view or None. Option to create a new entry if missing.'''
     sigs = None
     win = view.window()
     if win is not None:
-        project_fn = win.project_file_name()
-        if project_fn not in _sigs:
-            if init:
-                _sigs[project_fn] = {}
-                sigs = _sigs[project_fn]
-        else:
-            sigs = _sigs[project_fn]
-    return sigs
\ No newline at end of file
+        sigs = _store.get_project(_get_proj_fn(win), create=init)
+    return sigs
+
+
+#-----------------------------------------------------------------------------------
+def _on_store_changed(proj_fn, fn, rows, foreign):
+    ''' The store changed the signets for a file, or a whole project if fn is None. Drop what was made from them.
+    If another ST instance did it, show them in any open views too. '''
+    if fn is None:
+        _panel_items.pop(proj_fn, None)
+        return
+
+    _panel_items.get(proj_fn, {}).pop(fn, None)
+    if foreign:
+        _show_file_signets(proj_fn, fn, array('I', (r - 1 for r in rows)))
+
+
+#-----------------------------------------------------------------------------------
+def _scan_pattern(win, view, regex):
+    ''' Add signets for the regex matches in one view, or in all the project folders if view is None.
+    Open views are done from their text right away as it may not be saved. The other files are scanned on
+    a thread pool and the results handed back in batches so the UI keeps going. '''
+    global _scan_id
+    _scan_id += 1
+    scan_id = _scan_id
+    proj_fn = _get_proj_fn(win)
+    _store.get_project(proj_fn, create=True)
+
+    done = set()
+    added = 0
+    for v in [view] if view is not None else _get_window_views(win):
+        fn = _get_view_fn(v)
+        if fn not in done:
+            done.add(fn)
+            added += _add_view_matches(proj_fn, v, regex)
+    if view is not None:
+        sublime.status_message(f'{added} signets added')
+        return  # --- early return
+
+    folders = win.folders()
+    prefs = sublime.load_settings('Preferences.sublime-settings')
+    exclude_dirs = prefs.get('folder_exclude_patterns') or []
+    exclude_files = (prefs.get('file_exclude_patterns') or []) + (prefs.get('binary_file_patterns') or [])
+    totals = {'files': len(done), 'added': added}
+
+    def _add_batch(found, files, finished):
+        if scan_id != _scan_id:
+            return  # Superseded.
+        totals['files'] += files
+        totals['added'] += _add_file_matches(proj_fn, found)
+        more = '' if finished else '...'
+        sublime.status_message(f'{totals["added"]} signets added from {totals["files"]} files{more}')
+
+    def _scan():
+        found = []
+        files = 0
+        last = time.perf_counter()
+        try:
+            paths = (fn for fn in map(_paths.resolve, walk_folders(folders, exclude_dirs, exclude_files)) if fn not in done)
+            for fn, rows, fps in scan_files(paths, regex):
+                if scan_id != _scan_id:
+                    return  # Superseded.
+                files += 1
+                if len(rows) > 0:
+                    found.append((fn, rows, fps))
+                if time.perf_counter() - last >= SCAN_BATCH_TIME:
+                    sublime.set_timeout(functools.partial(_add_batch, found, files, False))
+                    found = []
+                    files = 0
+                    last = time.perf_counter()
+        except Exception as e:
+            sc.error(f'Pattern scan failed: {e}', e.__traceback__)
+        finally:
+            sublime.set_timeout(functools.partial(_add_batch, found, files, True))
+
+    # Its own thread as it can take a while and ST has only one async thread.
+    threading.Thread(target=_scan, daemon=True).start()
+
+
+#-----------------------------------------------------------------------------------
+def _add_view_matches(proj_fn, view, regex):
+    ''' Add signets for the regex matches in an open view, from its text. Returns how many were new. '''
+    fn = _get_view_fn(view)
+    if view.is_scratch() is True or fn is None:
+        return 0
+
+    text = view.substr(sublime.Region(0, view.size()))
+    rows, _ = find_lines(text, regex)
+    if len(rows) == 0:
+        return 0
+
+    old_rows = _get_view_signet_rows(view)
+    sig_rows = make_rows(itertools.chain(old_rows, (r - 1 for r in rows)))  # ST is 0-based
+    _show_file_signets(proj_fn, fn, sig_rows)
+
+    lines = text.split('\n')
+    rows = array('I', (r + 1 for r in sig_rows))
+    _store.set_rows(proj_fn, fn, rows, array('I', (line_fp(lines[r - 1]) for r in rows)))
+    return len(sig_rows) - len(old_rows)
+
+
+#-----------------------------------------------------------------------------------
+def _add_file_matches(proj_fn, found):
+    ''' Add signets for the regex matches in files on disk - list of (fn, rows, fps). Any of them opened since
+    the scan started get all their regions in one go. Returns how many were new. '''
+    added = 0
+    for fn, rows, fps in found:
+        added += _store.add_rows(proj_fn, fn, rows, fps)
+        _show_file_signets(proj_fn, fn, array('I', (r - 1 for r in _store.get_rows(proj_fn, fn))))
+    return added
+
+
+#-----------------------------------------------------------------------------------
+def _get_view_lines(view):
+    ''' All the text in the view as a list of lines, in one API call. '''
+    return view.substr(sublime.Region(0, view.size())).split('\n')
+
+
+#-----------------------------------------------------------------------------------
+def _get_view_line_starts(view):
+    ''' Like _get_view_lines() plus where each line starts. Returns (lines, starts). '''
+    lines = _get_view_lines(view)
+    return lines, list(itertools.accumulate((len(line) + 1 for line in lines), initial=0))
+
+
+#-----------------------------------------------------------------------------------
+def _get_panel_items(proj_fn, fn):
+    ''' Select panel items for one file and the rows they go to. Returns (items, rows).
+    Items show the line text as saved. If that isn't available yet they are made again when it is. '''
+    proj_items = _panel_items.setdefault(proj_fn, {})
+    if fn not in proj_items:
+        rows = _store.get_rows(proj_fn, fn)
+        texts = _get_line_texts(proj_fn, fn, rows) or [''] * len(rows)
+        real_fn = _paths.real_path(fn)
+        items = [sublime.QuickPanelItem(trigger=f'{real_fn} line:{line}', details=text, kind=sublime.KIND_AMBIGUOUS)
+                 for line, text in zip(rows, texts)]
+        proj_items[fn] = (items, rows)
+    return proj_items[fn]
+
+
+#-----------------------------------------------------------------------------------
+def _get_line_texts(proj_fn, fn, rows):
+    ''' Text of the 1-based rows in the file on disk. Returns None if the line index isn't ready - it gets built
+    in the background and the file's panel items are dropped when done. '''
+    try:
+        stat = os.stat(fn)
+    except OSError:
+        return None
+
+    entry = _line_index.get(fn)
+    if entry is None or entry[0] != stat.st_mtime or entry[1] != stat.st_size:
+        _index_lines_async(proj_fn, fn)
+        return None
+    _line_index.move_to_end(fn)
+
+    offsets = entry[2]
+    texts = []
+    try:
+        with open(fn, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for r in rows:
+                if r <= len(offsets):
+                    end = offsets[r] if r < len(offsets) else stat.st_size
+                    texts.append(mm[offsets[r - 1]:end].decode('utf-8', errors='replace').strip()[:PREVIEW_LEN])
+                else:
+                    texts.append('')
+    except (OSError, ValueError):
+        return None  # Empty or gone.
+    return texts
+
+
+#-----------------------------------------------------------------------------------
+def _prefetch_file(proj_fn, fn):
+    ''' A file is likely to be opened next. Start indexing its lines for previews in the background, unless the
+    index is already up to date. '''
+    try:
+        stat = os.stat(fn)
+    except OSError:
+        return
+
+    entry = _line_index.get(fn)
+    if entry is None or entry[0] != stat.st_mtime or entry[1] != stat.st_size:
+        _index_lines_async(proj_fn, fn)
+
+
+#-----------------------------------------------------------------------------------
+def _index_lines_async(proj_fn, fn):
+    ''' Build the line index for a file off the UI thread. '''
+    if fn in _line_index_pending:
+        return
+    _line_index_pending.add(fn)
+
+    def _done(entry):
+        _line_index_pending.discard(fn)
+        if entry is not None:
+            _line_index[fn] = entry
+            _line_index.move_to_end(fn)
+            while len(_line_index) > LINE_INDEX_MAX:
+                _line_index.popitem(last=False)
+            _panel_items.get(proj_fn, {}).pop(fn, None)
+
+    def _build():
+        entry = None
+        try:
+            entry = _index_lines(fn)
+        finally:
+            sublime.set_timeout(lambda: _done(entry))
+
+    sublime.set_timeout_async(_build)
+
+
+#-----------------------------------------------------------------------------------
+def _index_lines(fn):
+    ''' Find where each line starts. Returns (mtime, size, offsets) or None if it can't be read. '''
+    try:
+        stat = os.stat(fn)
+        offsets = array('Q', [0])
+        if stat.st_size > 0:
+            with open(fn, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                pos = mm.find(b'\n')
+                while pos >= 0:
+                    offsets.append(pos + 1)
+                    pos = mm.find(b'\n', pos + 1)
+        return (stat.st_mtime, stat.st_size, offsets)
+    except OSError:
+        return None
+
+
+#-----------------------------------------------------------------------------------
+def _get_store_format():
+    ''' compact unless json asked for. '''
+    return 'json' if sc.get_str_setting('store_format') == 'json' else 'compact'
+
+
@@ -0,0 +1,1094 @@
+import sys
+import os
+import json
+import time
+import zlib
+import hashlib
+import bisect
+import queue
+import threading
+import fnmatch
+import itertools
+import contextlib
+import collections
+import concurrent.futures
+from array import array
+
+if sys.platform == 'win32':
+    import msvcrt
+else:
+    import fcntl
+
+
+# Signet storage engine. Nothing from sublime in here so it can be scripted, profiled and benchmarked anywhere.
+# The plugin is a thin layer over this - see sbot_signet.py. Typical use:
+#
+#   store = SignetStore(store_dir, 'SignetBookmarks')
+#   store.read()
+#   store.toggle(proj_fn, fn, 10)
+#   store.find_next(proj_fn, fn, 10)
+#   store.save(wait=True)
+#
+# Rows are 1-based line numbers. Each project has a shard file plus a journal of changes, listed in a manifest.
+# Any number of stores, in this process or other ones, can share a store_dir.
+
+
+# Definitions.
+
+# Fold a shard journal into the shard when it gets bigger than this.
+JOURNAL_COMPACT_SIZE = 64 * 1024
+
+# Save this long after the last change, msec.
+AUTOSAVE_DELAY = 2000
+
+# Threads for scanning files, and files bigger than this are not scanned.
+SCAN_WORKERS = 8
+SCAN_MAX_SIZE = 16 * 1024 * 1024
+
+# Resolved directories PathResolver remembers.
+PATH_CACHE_MAX = 5000
+
+# Paths differing only in case are the same file here.
+_CASE_FOLDED = os.path.normcase('A') != 'A'
+
+
+#-----------------------------------------------------------------------------------
+class SignetStore():
+    ''' The signets for all projects and their persistence. The host supplies how to call back:
+    post(func) runs func on the host main thread, run_async(func) runs it in the background,
+    call_later(func, msec) is for autosave, on_error(message, tb) reports problems, and
+    on_changed(proj_fn, fn, rows, foreign) is told when the signets for a file change - fn is None if the whole
+    project went and foreign is True if another store did it. Without them everything runs in line and
+    there is no autosave. resolve_path(path) makes the canonical key for a path - see PathResolver. It is applied to
+    what is read from disk, callers pass keys already resolved. Methods are not thread safe - call them from one
+    thread. '''
+
+    def __init__(self, store_dir, name, post=None, run_async=None, call_later=None, on_error=None, on_changed=None,
+                 resolve_path=None):
+        self.store_dir = store_dir
+        self.name = name
+
+        # Format for writing shards: compact OR json. Either is read.
+        self.store_format = 'compact'
+
+        self._post = post if post is not None else lambda func: func()
+        self._run_async = run_async if run_async is not None else lambda func: func()
+        self._call_later = call_later
+        self._on_error = on_error if on_error is not None else lambda message, tb: print(message, file=sys.stderr)
+        self._on_changed = on_changed if on_changed is not None else lambda proj_fn, fn, rows, foreign: None
+        self._resolve_path = resolve_path if resolve_path is not None else lambda path: path
+
+        # The current signets. Key is proj_fn, value is dict of fn to sorted 1-based rows - see make_rows().
+        # Rows (and fps) are always replaced, never changed in place, so a shallow copy is a snapshot.
+        # Only projects that have been asked for are loaded.
+        self._sigs = {}
+
+        # Fingerprint of the line text for each signet so they can be found again if the file changes elsewhere.
+        # Same layout as _sigs and aligned with its rows. 0 means not known.
+        self._fps = {}
+
+        # Sorted files with signets per project, for traversing the whole project in a fixed order. Built on demand.
+        self._sig_files = {}
+
+        # Which shard holds each project. Key is proj_fn, value is dict with shard name and version.
+        # The version is bumped each time the shard is rewritten so other stores can tell.
+        self._manifest = {}
+
+        # Projects whose shard has been read into _sigs.
+        self._loaded = set()
+
+        # Files whose signets have changed since last journaled. Set of (proj_fn, fn).
+        self._dirty = set()
+
+        # Other records waiting to be journaled, in order. List of (proj_fn, rec).
+        self._pending = []
+
+        # Each save() that journals anything is numbered, so changes from other stores can be ordered against it.
+        # Key is (proj_fn, fn) - fn is None for a clear - and value is the number of the save that last journaled it.
+        self._save_seq = 0
+        self._saved = {}
+
+        # Save numbers up to this were before the last read(). Changes from other stores seen then are stale.
+        self._read_seq = 0
+
+        # Approximate size of each shard journal so it can be compacted without a stat. Key is proj_fn.
+        self._journal_sizes = {}
+
+        # When the last unsaved change was made, None if there isn't one. time.monotonic().
+        self._last_change = None
+
+        # There is an autosave timer waiting. Only ever one.
+        self._autosave_armed = False
+
+        # File writes are done in order on a worker thread. Items are (func, args).
+        self._write_queue = queue.Queue()
+        self._writer_thread = None
+
+        # Store files are only touched while holding this, and the lock file for other processes.
+        self._mutex = threading.Lock()
+
+        # What this store last saw of each shard on disk. Only used while holding the store lock.
+        # Key is proj_fn, value is [version, journal size]. Anything else was written by another store.
+        self._disk_state = {}
+
+    #--------------------------- Public -------------------------------------------
+
+    def read(self):
+        ''' Start over from what's on disk. Reads just the manifest - projects are loaded when first asked for.
+        An old single store is converted. Returns False if there is no store yet. '''
+        # Anything from before goes to disk first.
+        self.save(wait=True)
+
+        self._sigs.clear()
+        self._fps.clear()
+        self._sig_files.clear()
+        self._loaded.clear()
+        self._dirty.clear()
+        self._pending.clear()
+        self._saved.clear()
+        self._save_seq += 1
+        self._read_seq = self._save_seq
+        self._journal_sizes.clear()
+        with self._lock():
+            self._disk_state.clear()
+
+        manifest_fn = self._get_fn('.manifest')
+        if not os.path.isfile(manifest_fn):
+            self._manifest = {}
+            if os.path.isfile(self._get_fn('.store')):
+                self._migrate()
+                return True
+            return False
+
+        try:
+            with open(manifest_fn, 'r') as fp:
+                _temp_manifest = json.load(fp)
+        except Exception as e:
+            self._on_error(f'Error reading {manifest_fn}: {e}', e.__traceback__)
+            return True
+
+        # Use it now, forget projects that have gone away later.
+        self._manifest = self._resolve_keys(_temp_manifest)
+        self._validate_async(list(self._manifest), self._prune_projects)
+        return True
+
+    def save(self, wait=False):
+        ''' Hand everything that changed to the writer. Fold a shard journal into the shard if it got too big.
+        Option to wait until it is all on disk. '''
+        self._last_change = None
+
+        # Records in order, then the current state of each dirty file.
+        recs = {}
+        for proj_fn, rec in self._pending:
+            recs.setdefault(proj_fn, []).append(rec)
+        for proj_fn, fn in self._dirty:
+            if proj_fn is not None:
+                rows = self._sigs.get(proj_fn, {}).get(fn, [])
+                fps = self.get_fps(proj_fn, fn)
+                recs.setdefault(proj_fn, []).append({'op': 'set', 'fn': fn, 'rows': list(rows), 'fps': list(fps)})
+        self._pending.clear()
+        self._dirty.clear()
+        if len(recs) > 0:
+            self._save_seq += 1
+
+        for proj_fn, proj_recs in recs.items():
+            if proj_fn not in self._manifest:
+                self._add_shard(proj_fn)
+
+            text = ''.join(json.dumps(rec) + '\n' for rec in proj_recs)
+            for rec in proj_recs:
+                self._saved[(proj_fn, rec.get('fn'))] = self._save_seq
+            self._journal_sizes[proj_fn] = self._journal_sizes.get(proj_fn, 0) + len(text)
+            self._queue_write(self._append_journal, proj_fn, self._manifest[proj_fn]['shard'], text, self._save_seq)
+            if self._journal_sizes[proj_fn] > JOURNAL_COMPACT_SIZE:
+                self.compact(proj_fn)
+
+        if wait:
+            self._write_queue.join()
+
+    def compact(self, proj_fn):
+        ''' Fold the shard journal into a new shard snapshot and start a fresh journal. '''
+        if proj_fn in self._manifest:
+            self._journal_sizes[proj_fn] = 0
+            # Everything saved so far is folded in.
+            self._queue_write(self._fold_shard, proj_fn, self._manifest[proj_fn]['shard'], self.store_format,
+                              self._save_seq + 1)
+
+    def get_project(self, proj_fn, create=False):
+        ''' The signets for a project as {fn: rows}, loaded if need be. None if it has none, unless create.
+        Read only - use the other methods to change it. '''
+        if proj_fn not in self._loaded:
+            self._load_shard(proj_fn)
+        if proj_fn not in self._sigs and create:
+            self._sigs[proj_fn] = {}
+        return self._sigs.get(proj_fn)
+
+    def get_rows(self, proj_fn, fn):
+        ''' Sorted 1-based rows for a file, maybe empty. '''
+        return (self.get_project(proj_fn) or {}).get(fn, make_rows())
+
+    def get_fps(self, proj_fn, fn):
+        ''' Fingerprints aligned with the rows for a file. '''
+        fps = self._fps.get(proj_fn, {}).get(fn)
+        if fps is None:
+            fps = array('I', [0]) * len(self._sigs.get(proj_fn, {}).get(fn, []))
+        return fps
+
+    def get_files(self, proj_fn):
+        ''' Sorted list of the files with signets in the project. '''
+        sig_files = self._sig_files.get(proj_fn)
+        if sig_files is None:
+            sig_files = sorted(self.get_project(proj_fn) or {})
+            self._sig_files[proj_fn] = sig_files
+        return sig_files
+
+    def set_rows(self, proj_fn, fn, rows, fps=None):
+        ''' Replace the signets for a file. rows are sorted unique 1-based - see make_rows(). fps are the aligned
+        line fingerprints if known. Saved later. Returns True if anything changed. '''
+        rows = rows if isinstance(rows, array) else array('I', rows)
+        fps = fps if fps is not None else array('I', [0]) * len(rows)
+        if rows == self.get_rows(proj_fn, fn) and fps == self.get_fps(proj_fn, fn):
+            return False
+
+        self._set_file(proj_fn, fn, rows, fps)
+        self._dirty.add((proj_fn, fn))
+        self._schedule_save()
+        return True
+
+    def toggle(self, proj_fn, fn, row, fp=0):
+        ''' Add or remove the signet at 1-based row. fp is the line fingerprint if known - see line_fp().
+        Returns True if it was added. '''
+        rows = self.get_rows(proj_fn, fn)
+        fps = self.get_fps(proj_fn, fn)
+        i = bisect.bisect_left(rows, row)
+        added = not (i < len(rows) and rows[i] == row)
+        if added:
+            self.set_rows(proj_fn, fn, rows[:i] + array('I', [row]) + rows[i:], fps[:i] + array('I', [fp]) + fps[i:])
+        else:
+            self.set_rows(proj_fn, fn, rows[:i] + rows[i + 1:], fps[:i] + fps[i + 1:])
+        return added
+
+    def add_rows(self, proj_fn, fn, rows, fps=None):
+        ''' Add signets to a file, keeping the ones already there. Same args as set_rows().
+        Returns how many were new. '''
+        old_rows = self.get_rows(proj_fn, fn)
+        pairs = dict(zip(old_rows, self.get_fps(proj_fn, fn)))
+        pairs.update(zip(rows, fps if fps is not None else [0] * len(rows)))
+        self.set_rows(proj_fn, fn, *make_fps(list(pairs), list(pairs.values())))
+        return len(pairs) - len(old_rows)
+
+    def clear_file(self, proj_fn, fn):
+        ''' Remove all signets in a file. '''
+        self.set_rows(proj_fn, fn, make_rows())
+
+    def clear_project(self, proj_fn):
+        ''' Remove all signets in a project. '''
+        self.get_project(proj_fn)  # So loading later doesn't bring them back.
+        self._sigs.pop(proj_fn, None)
+        self._fps.pop(proj_fn, None)
+        self._sig_files.pop(proj_fn, None)
+        self._on_changed(proj_fn, None, None, False)
+        self._journal(proj_fn, {'op': 'clear'})
+
+    def iter_files(self, proj_fn, fn, forward=True):
+        ''' Files with signets in navigation order - path order starting after fn and wrapping around,
+        so fn itself is last if it has any. '''
+        sig_files = self.get_files(proj_fn)
+        if forward:
+            i = bisect.bisect_right(sig_files, fn)
+        else:
+            i = bisect.bisect_left(sig_files, fn) - 1
+        for _ in range(len(sig_files)):
+            yield sig_files[i % len(sig_files)]
+            i += 1 if forward else -1
+
+    def find_next(self, proj_fn, fn, row, forward=True, all_files=True):
+        ''' Where next/prev from 1-based row in fn goes. Returns (fn, row) or None if there are no signets. '''
+        rows = self.get_rows(proj_fn, fn)
+        if forward:
+            i = bisect.bisect_right(rows, row)
+        else:
+            i = bisect.bisect_left(rows, row) - 1
+        if 0 <= i < len(rows):
+            return fn, rows[i]
+
+        if all_files:
+            for target_fn in self.iter_files(proj_fn, fn, forward):
+                return target_fn, self.get_rows(proj_fn, target_fn)[0 if forward else -1]
+        elif len(rows) > 0:
+            return fn, rows[0 if forward else -1]
+        return None
+
+    def relocate(self, proj_fn, fn, lines):
+        ''' The file may have changed since its signets were saved. Move any whose line moved, going by the
+        fingerprints. lines is the current text. Returns how many could not be found - they stay put. '''
+        fps = self.get_fps(proj_fn, fn)
+        if not any(fps):
+            return 0
+        rows, fps, lost = relocate_rows(self.get_rows(proj_fn, fn), fps, lines)
+        self.set_rows(proj_fn, fn, rows, fps)
+        return lost
+
+    #--------------------------- Files --------------------------------------------
+
+    def _get_fn(self, ext):
+        ''' One of the top level files: .manifest, .lock, or the old single .store and .journal. '''
+        return os.path.join(self.store_dir, self.name + ext)
+
+    def _get_shard_fns(self, shard):
+        ''' (store_fn, journal_fn) for a shard name. '''
+        shard_fn = os.path.join(self.store_dir, 'shards', shard)
+        return shard_fn + '.store', shard_fn + '.journal'
+
+    def _add_shard(self, proj_fn):
+        ''' Make a manifest entry for a new project. Name is readable but unique, and the same in every store.
+        It goes on disk with the first journal write. '''
+        stem = os.path.splitext(os.path.basename(proj_fn))[0]
+        digest = hashlib.md5(proj_fn.encode('utf-8')).hexdigest()[:12]
+        self._manifest[proj_fn] = {'shard': f'{stem}_{digest}', 'version': 0}
+
+    @contextlib.contextmanager
+    def _lock(self):
+        ''' Hold the store against other threads and other processes. Blocks until it's free. '''
+        lock_fn = self._get_fn('.lock')
+        with self._mutex:
+            os.makedirs(self.store_dir, exist_ok=True)
+            with open(lock_fn, 'a+b') as fp:
+                if sys.platform == 'win32':
+                    fp.seek(0)
+                    msvcrt.locking(fp.fileno(), msvcrt.LK_LOCK, 1)  # Gives up after 10 seconds.
+                else:
+                    fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    if sys.platform == 'win32':
+                        fp.seek(0)
+                        msvcrt.locking(fp.fileno(), msvcrt.LK_UNLCK, 1)
+                    else:
+                        fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+    def _read_disk_manifest(self):
+        ''' Hold the store lock. The manifest on disk. Read every time - it's small, and file times are too coarse
+        on some file systems to tell if another store rewrote it. '''
+        manifest_fn = self._get_fn('.manifest')
+        try:
+            with open(manifest_fn, 'r') as fp:
+                return self._resolve_keys(json.load(fp))
+        except OSError:
+            return {}
+
+    def _write_disk_manifest(self, manifest):
+        ''' Hold the store lock. '''
+        _write_json(self._get_fn('.manifest'), manifest)
+
+    def _load_shard(self, proj_fn):
+        ''' First time a project is asked for. Replays the journal over the snapshot. Cleans up bad entries. '''
+        self._loaded.add(proj_fn)
+
+        entry = self._manifest.get(proj_fn)
+        if entry is None:
+            return
+        store_fn, journal_fn = self._get_shard_fns(entry['shard'])
+
+        # Consistent with what other stores have written.
+        try:
+            with self._lock():
+                version = self._read_disk_manifest().get(proj_fn, {}).get('version', 0)
+                _temp_sigs, store_format = _read_shard(proj_fn, store_fn)
+                recs, size = _read_journal(journal_fn)
+                self._disk_state[proj_fn] = [version, size]
+        except Exception as e:
+            self._on_error(f'Error reading {store_fn}: {e}', e.__traceback__)
+            return
+
+        for rec in recs:
+            _apply_journal_rec(_temp_sigs, rec)
+        self._journal_sizes[proj_fn] = size
+
+        # Sanity checks. Easier to make a new clean collection rather than remove parts.
+        # Files that have gone away are pruned later.
+        files = {}
+        files_fps = {}
+        for fn, entry in _temp_sigs.items():
+            rows, fps = _parse_sigs(entry)
+            if len(rows) > 0:
+                files[fn] = rows
+                files_fps[fn] = fps
+        if len(files) > 0:
+            self._sigs[proj_fn] = files
+            self._fps[proj_fn] = files_fps
+            self._sig_files.pop(proj_fn, None)
+            self._on_changed(proj_fn, None, None, False)
+            # Paths written before they were resolved, or by something that doesn't, are fixed up in the
+            # background as resolving them hits the file system.
+            self._check_files_async(proj_fn, list(files))
+
+            # Rewrite in the current format if it was changed.
+            if store_format is not None and store_format != self.store_format:
+                self.compact(proj_fn)
+
+    def _migrate(self):
+        ''' Split an old single store (plus journal) into shards. The old store is kept as .bak. '''
+        store_fn = self._get_fn('.store')
+        journal_fn = self._get_fn('.journal')
+
+        try:
+            with open(store_fn, 'r') as fp:
+                _temp_sigs = json.load(fp)
+
+            # Old journal records carry the project.
+            for rec in _read_journal(journal_fn)[0]:
+                _apply_journal_rec(_temp_sigs.setdefault(rec.get('proj'), {}), rec)
+
+            for proj_fn, proj_sigs in self._resolve_keys(_temp_sigs).items():
+                if os.path.exists(proj_fn) and len(proj_sigs) > 0:
+                    self._add_shard(proj_fn)
+                    for fn, entry in self._resolve_sigs(proj_sigs).items():
+                        self._set_file(proj_fn, fn, *_parse_sigs(entry))
+                    # Shallow copy is enough - see _sigs.
+                    self._queue_write(self._replace_shard, proj_fn, self._manifest[proj_fn]['shard'],
+                                      dict(self._sigs[proj_fn]), dict(self._fps[proj_fn]), self.store_format)
+
+            self._sigs.clear()
+            self._fps.clear()
+            self._sig_files.clear()
+            self._write_queue.join()
+            os.replace(store_fn, store_fn + '.bak')
+            if os.path.isfile(journal_fn):
+                os.remove(journal_fn)
+
+        except Exception as e:
+            self._on_error(f'Error migrating {store_fn}: {e}', e.__traceback__)
+
+    #--------------------------- Changes ------------------------------------------
+
+    def _set_file(self, proj_fn, fn, rows, fps, foreign=False):
+        ''' Update the signets for one file, keeping the traversal index in step. Empty rows removes the file. '''
+        proj_sigs = self._sigs.setdefault(proj_fn, {})
+        proj_fps = self._fps.setdefault(proj_fn, {})
+        had = fn in proj_sigs
+        has = len(rows) > 0
+
+        if has:
+            proj_sigs[fn] = rows
+            proj_fps[fn] = fps
+        else:
+            proj_sigs.pop(fn, None)
+            proj_fps.pop(fn, None)
+
+        sig_files = self._sig_files.get(proj_fn)
+        if sig_files is not None and had != has:
+            i = bisect.bisect_left(sig_files, fn)
+            if has:
+                sig_files.insert(i, fn)
+            else:
+                del sig_files[i]
+
+        self._on_changed(proj_fn, fn, rows, foreign)
+
+    def _journal(self, proj_fn, rec):
+        ''' Queue one delta record for the project shard journal. '''
+        if proj_fn is None:
+            return  # Not persisted without a project.
+        self._pending.append((proj_fn, rec))
+        self._schedule_save()
+
+    def _schedule_save(self):
+        ''' Save after things have been quiet for a bit. Each call restarts the wait, but there is only one timer -
+        when it goes off it waits again for whatever is left. '''
+        if self._call_later is None:
+            return
+
+        self._last_change = time.monotonic()
+        if not self._autosave_armed:
+            self._autosave_armed = True
+            self._call_later(self._autosave, AUTOSAVE_DELAY)
+
+    def _autosave(self):
+        ''' The autosave timer went off. '''
+        self._autosave_armed = False
+        if self._last_change is None:
+            return  # Saved already.
+
+        remaining = AUTOSAVE_DELAY - int((time.monotonic() - self._last_change) * 1000)
+        if remaining > 0:
+            self._autosave_armed = True
+            self._call_later(self._autosave, remaining)
+        else:
+            self.save()
+
+    def _merge_foreign(self, proj_fn, foreign, seq):
+        ''' Another store changed a shard. Take its changes for files this one hasn't changed since.
+        foreign is ('state', {fn: entry}) if it was rewritten, or ('recs', [rec]) for what was added to the journal,
+        with the paths resolved.
+        What this store journaled in save number seq and later went to disk after those changes, so it wins.
+        So do changes not saved yet. '''
+        if proj_fn not in self._loaded or seq <= self._read_seq:
+            return
+        if self._saved.get((proj_fn, None), 0) >= seq or any(p == proj_fn for p, _ in self._pending):
+            return  # Cleared here since.
+
+        proj_sigs = self._sigs.get(proj_fn, {})
+        kind, data = foreign
+        if kind == 'state':
+            theirs = {fn: data.get(fn, []) for fn in set(proj_sigs) | set(data)}
+        else:
+            theirs = {}
+            for rec in data:
+                if rec.get('op') == 'clear':
+                    theirs = {fn: [] for fn in set(proj_sigs) | set(theirs)}
+                elif rec.get('op') == 'set':
+                    theirs[rec['fn']] = rec
+
+        for fn, entry in theirs.items():
+            if self._saved.get((proj_fn, fn), 0) >= seq or (proj_fn, fn) in self._dirty:
+                continue
+            rows, fps = _parse_sigs(entry)
+            if rows != self._sigs.get(proj_fn, {}).get(fn, make_rows()) or fps != self.get_fps(proj_fn, fn):
+                self._set_file(proj_fn, fn, rows, fps, foreign=True)
+
+    #--------------------------- Paths --------------------------------------------
+
+    def _resolve_keys(self, entries):
+        ''' entries with their path keys resolved. If two resolve the same the first is kept. '''
+        resolved = {}
+        for path, entry in entries.items():
+            resolved.setdefault(self._resolve_path(path), entry)
+        return resolved
+
+    def _resolve_sigs(self, proj_sigs):
+        ''' Shard or journal file entries with their paths resolved. Ones for the same file are merged. '''
+        resolved = {}
+        for fn, entry in proj_sigs.items():
+            key = self._resolve_path(fn)
+            if key in resolved:
+                rows, fps = _parse_sigs(resolved[key])
+                more_rows, more_fps = _parse_sigs(entry)
+                rows, fps = make_fps(list(rows) + list(more_rows), list(fps) + list(more_fps))
+                entry = {'rows': list(rows), 'fps': list(fps)}
+            resolved[key] = entry
+        return resolved
+
+    #--------------------------- Validation ---------------------------------------
+
+    def _validate_async(self, paths, on_missing):
+        ''' Check paths exist in the background. on_missing(missing) is posted back if any are gone. '''
+        def _check():
+            missing = _find_missing(paths)
+            if len(missing) > 0:
+                self._post(lambda: on_missing(missing))
+
+        self._run_async(_check)
+
+    def _prune_projects(self, missing):
+        ''' Forget projects that have gone away. '''
+        for proj_fn in missing:
+            entry = self._manifest.pop(proj_fn, None)
+            if entry is not None:
+                self._queue_write(self._remove_shard, proj_fn, entry['shard'])
+                self._sigs.pop(proj_fn, None)
+                self._fps.pop(proj_fn, None)
+                self._sig_files.pop(proj_fn, None)
+                self._on_changed(proj_fn, None, None, False)
+
+    def _check_files_async(self, proj_fn, paths):
+        ''' Check the files of a freshly loaded project in the background. Ones that have gone are pruned
+        and ones keyed by unresolved paths are moved to the resolved ones. '''
+        def _check():
+            missing = _find_missing(paths)
+            resolved = {}
+            for fn in paths:
+                key = self._resolve_path(fn)
+                if key != fn and fn not in missing:
+                    resolved[fn] = key
+            if len(missing) > 0 or len(resolved) > 0:
+                self._post(lambda: self._fix_files(proj_fn, missing, resolved))
+
+        self._run_async(_check)
+
+    def _fix_files(self, proj_fn, missing, resolved):
+        ''' Results of _check_files_async(). Unresolved ones are merged into what's there for the resolved path,
+        shown as if changed elsewhere, and the shard is rewritten so the disk has only resolved paths. '''
+        self._prune_files(proj_fn, missing)
+        proj_sigs = self._sigs.get(proj_fn)
+        if proj_sigs is None or len(resolved) == 0:
+            return
+
+        for fn, key in resolved.items():
+            if fn in proj_sigs:
+                rows = list(proj_sigs[fn]) + list(self.get_rows(proj_fn, key))
+                fps = list(self.get_fps(proj_fn, fn)) + list(self.get_fps(proj_fn, key))
+                self._set_file(proj_fn, fn, make_rows(), make_rows())
+                self._set_file(proj_fn, key, *make_fps(rows, fps), foreign=True)
+        # From disk, where _fold_shard() resolves them the same way.
+        self.compact(proj_fn)
+
+    def _prune_files(self, proj_fn, missing):
+        ''' Forget files that have gone away. They get journaled as removed on the next write. '''
+        proj_sigs = self._sigs.get(proj_fn)
+        if proj_sigs is not None:
+            for fn in missing:
+                if fn in proj_sigs:
+                    self.clear_file(proj_fn, fn)
+            if len(proj_sigs) == 0:
+                del self._sigs[proj_fn]
+
+    #--------------------------- Writer thread ------------------------------------
+
+    def _queue_write(self, func, *args):
+        ''' Run func(*args) on the writer thread, after anything already queued. '''
+        if self._writer_thread is None:
+            self._writer_thread = threading.Thread(target=self._run_writer, daemon=True)
+            self._writer_thread.start()
+        self._write_queue.put((func, args))
+
+    def _run_writer(self):
+        ''' Writer thread. Reports errors back with post. '''
+        while True:
+            func, args = self._write_queue.get()
+            try:
+                func(*args)
+            except Exception as e:
+                self._post(lambda e=e: self._on_error(f'Error writing store: {e}', e.__traceback__))
+            finally:
+                self._write_queue.task_done()
+
+    def _check_disk_state(self, proj_fn, manifest, journal_fn):
+        ''' Hold the store lock. What another store did to the shard since this one last looked.
+        Returns None if nothing, else ('state', None) if it was rewritten or ('recs', [rec]) if the journal grew. '''
+        version = manifest.get(proj_fn, {}).get('version', 0)
+        known = self._disk_state.get(proj_fn, [0, 0])
+        size = os.path.getsize(journal_fn) if os.path.isfile(journal_fn) else 0
+
+        if version != known[0] or size < known[1]:
+            return ('state', None)
+        if size > known[1]:
+            return ('recs', _read_journal(journal_fn, known[1])[0])
+        return None
+
+    def _append_journal(self, proj_fn, shard, text, seq):
+        ''' Writer thread. Add records to a shard journal from save number seq. Changes from other stores are picked
+        up on the way. '''
+        store_fn, journal_fn = self._get_shard_fns(shard)
+        with self._lock():
+            manifest = self._read_disk_manifest()
+            foreign = self._check_disk_state(proj_fn, manifest, journal_fn)
+            if foreign is not None and foreign[0] == 'state':
+                proj_sigs, _ = _read_shard(proj_fn, store_fn)
+                for rec in _read_journal(journal_fn)[0]:
+                    _apply_journal_rec(proj_sigs, rec)
+                foreign = ('state', self._resolve_sigs(proj_sigs))
+            elif foreign is not None:
+                foreign = ('recs', [dict(rec, fn=self._resolve_path(rec['fn'])) if 'fn' in rec else rec
+                                    for rec in foreign[1]])
+
+            if proj_fn not in manifest:
+                manifest = dict(manifest)
+                manifest[proj_fn] = {'shard': shard, 'version': 0}
+                self._write_disk_manifest(manifest)
+
+            _append_file(journal_fn, text)
+            self._disk_state[proj_fn] = [manifest[proj_fn].get('version', 0), os.path.getsize(journal_fn)]
+
+        if foreign is not None:
+            self._post(lambda: self._merge_foreign(proj_fn, foreign, seq))
+
+    def _fold_shard(self, proj_fn, shard, store_format, seq):
+        ''' Writer thread. Fold the journal on disk into a new shard and start a fresh journal. It's done from
+        what's on disk so nothing written by other stores is lost. Empty projects are dropped. seq is the first
+        save number not folded in. '''
+        store_fn, journal_fn = self._get_shard_fns(shard)
+        with self._lock():
+            manifest = self._read_disk_manifest()
+            changed = self._check_disk_state(proj_fn, manifest, journal_fn) is not None
+
+            proj_sigs, _ = _read_shard(proj_fn, store_fn)
+            for rec in _read_journal(journal_fn)[0]:
+                _apply_journal_rec(proj_sigs, rec)
+            proj_sigs = self._resolve_sigs(proj_sigs)
+
+            manifest = dict(manifest)
+            if len(proj_sigs) == 0:
+                _remove_files([store_fn, journal_fn])
+                manifest.pop(proj_fn, None)
+                self._disk_state.pop(proj_fn, None)
+            else:
+                version = manifest.get(proj_fn, {}).get('version', 0) + 1
+                _write_shard(proj_fn, store_fn, journal_fn, proj_sigs, store_format)
+                manifest[proj_fn] = {'shard': shard, 'version': version}
+                self._disk_state[proj_fn] = [version, 0]
+            self._write_disk_manifest(manifest)
+
+        if changed:
+            self._post(lambda: self._merge_foreign(proj_fn, ('state', proj_sigs), seq))
+
+    def _replace_shard(self, proj_fn, shard, proj_sigs, proj_fps, store_format):
+        ''' Writer thread. Write a shard from scratch, for migration. '''
+        store_fn, journal_fn = self._get_shard_fns(shard)
+        with self._lock():
+            manifest = dict(self._read_disk_manifest())
+            version = manifest.get(proj_fn, {}).get('version', 0) + 1
+            entries = {fn: {'rows': rows, 'fps': proj_fps.get(fn, [])} for fn, rows in proj_sigs.items()}
+            _write_shard(proj_fn, store_fn, journal_fn, entries, store_format)
+            manifest[proj_fn] = {'shard': shard, 'version': version}
+            self._disk_state[proj_fn] = [version, 0]
+            self._write_disk_manifest(manifest)
+
+    def _remove_shard(self, proj_fn, shard):
+        ''' Writer thread. Delete a project shard. '''
+        with self._lock():
+            _remove_files(self._get_shard_fns(shard))
+            manifest = dict(self._read_disk_manifest())
+            if manifest.pop(proj_fn, None) is not None:
+                self._write_disk_manifest(manifest)
+            self._disk_state.pop(proj_fn, None)
+
+
+#-----------------------------------------------------------------------------------
+class PathResolver():
+    ''' Canonical paths to use as store keys, so the same file always gets the same key. Symlinks and .. in the
+    directories are resolved and case is folded if the file system ignores it. Directories are resolved once and
+    remembered, least recently used dropped past max_dirs, so there is no file system access per path. The file
+    name itself is only case folded. Keys are for comparing - use real_path() to get one to show or open.
+    Call clear() when what the directories point to may have changed. Thread safe. '''
+
+    def __init__(self, max_dirs=PATH_CACHE_MAX):
+        self.max_dirs = max_dirs
+
+        # Key is directory as given, value is resolved. Least recently used first.
+        self._dirs = collections.OrderedDict()
+
+        # Where case is folded, the path with its case for each key seen. Same size limit.
+        self._real = collections.OrderedDict()
+        self._mutex = threading.Lock()
+
+    def resolve(self, path):
+        ''' The canonical form of path. None stays None. '''
+        if path is None:
+            return None
+        dir, name = os.path.split(path)
+        with self._mutex:
+            resolved = self._dirs.get(dir)
+            if resolved is None:
+                resolved = os.path.realpath(dir)
+                self._dirs[dir] = resolved
+                while len(self._dirs) > self.max_dirs:
+                    self._dirs.popitem(last=False)
+            else:
+                self._dirs.move_to_end(dir)
+
+            real = os.path.join(resolved, name)
+            key = os.path.normcase(real)
+            if _CASE_FOLDED:
+                self._remember(key, real)
+        return key
+
+    def real_path(self, key):
+        ''' The path to show or open for a key from resolve(). Where case is folded it's as last given, or as it
+        is on disk if the key came from elsewhere. '''
+        if key is None or not _CASE_FOLDED:
+            return key
+        with self._mutex:
+            real = self._real.get(key)
+            if real is not None:
+                self._real.move_to_end(key)
+                return real
+        real = os.path.realpath(key)
+        with self._mutex:
+            self._remember(key, real)
+        return real
+
+    def clear(self):
+        ''' Forget all the resolved directories. '''
+        with self._mutex:
+            self._dirs.clear()
+            self._real.clear()
+
+    def _remember(self, key, real):
+        ''' Hold the mutex. '''
+        self._real[key] = real
+        self._real.move_to_end(key)
+        while len(self._real) > self.max_dirs:
+            self._real.popitem(last=False)
+
+
+#-----------------------------------------------------------------------------------
+def make_rows(rows=()):
+    ''' Signet rows are kept as a sorted array of unique ints. Much smaller than a list and bisectable. '''
+    return array('I', sorted(set(rows)))
+
+
+#-----------------------------------------------------------------------------------
+def make_fps(rows, fps):
+    ''' Like make_rows() but keeps the fingerprints aligned. Returns (rows, fps). '''
+    pairs = dict(zip(rows, fps))
+    sorted_rows = sorted(pairs)
+    return array('I', sorted_rows), array('I', (pairs[r] for r in sorted_rows))
+
+
+#-----------------------------------------------------------------------------------
+def line_fp(text):
+    ''' Short fingerprint of a line of text. Leading and trailing whitespace doesn't count. Never 0. '''
+    return zlib.crc32(text.strip().encode('utf-8')) or 1
+
+
+#-----------------------------------------------------------------------------------
+def relocate_rows(rows, fps, lines):
+    ''' Find where signets went after the text changed. rows are 1-based with fps aligned.
+    Lines are indexed by fingerprint in one pass, only if something moved. A moved signet goes to the nearest
+    line with the same fingerprint. Returns (rows, fps, lost) where lost is how many could not be found
+    and were left where they were. '''
+    index = None
+    new_rows = []
+    lost = 0
+
+    for r, fp in zip(rows, fps):
+        if fp == 0 or (r <= len(lines) and line_fp(lines[r - 1]) == fp):
+            new_rows.append(r)  # Not known or still there.
+            continue
+
+        if index is None:
+            index = {}
+            for i, line in enumerate(lines):
+                index.setdefault(line_fp(line), []).append(i + 1)
+
+        candidates = index.get(fp)
+        if candidates is None:
+            new_rows.append(r)
+            lost += 1
+        else:
+            i = bisect.bisect_left(candidates, r)
+            new_rows.append(min(candidates[max(i - 1, 0):i + 1], key=lambda c: abs(c - r)))
+
+    new_rows, new_fps = make_fps(new_rows, fps)
+    return new_rows, new_fps, lost
+
+
+#-----------------------------------------------------------------------------------
+def find_lines(text, regex):
+    ''' The lines in text that compiled regex matches anywhere in. A match over several lines counts for the first.
+    Returns (rows, fps) - 1-based, sorted. '''
+    rows = array('I')
+    fps = array('I')
+    row = 1
+    counted = 0  # Newlines before here are in row.
+    line_end = -1
+
+    for m in regex.finditer(text):
+        start = m.start()
+        if start <= line_end:
+            continue  # Already have this line.
+        row += text.count('\n', counted, start)
+        counted = start
+        line_end = text.find('\n', start)
+        if line_end < 0:
+            line_end = len(text)
+        rows.append(row)
+        fps.append(line_fp(text[text.rfind('\n', 0, start) + 1:line_end]))
+    return rows, fps
+
+
+#-----------------------------------------------------------------------------------
+def scan_file(fn, regex):
+    ''' find_lines() for a file on disk. Binary, huge and unreadable files have none. Returns (rows, fps). '''
+    try:
+        with open(fn, 'rb') as fp:
+            if os.fstat(fp.fileno()).st_size <= SCAN_MAX_SIZE:
+                data = fp.read()
+                if b'\0' not in data[:8192]:
+                    return find_lines(data.decode('utf-8', errors='replace'), regex)
+    except OSError:
+        pass
+    return array('I'), array('I')
+
+
+#-----------------------------------------------------------------------------------
+def scan_files(paths, regex, workers=SCAN_WORKERS):
+    ''' scan_file() for each of paths on a thread pool. Only a few are in flight at a time so paths can be a lazy
+    iterable of any length, and stopping early is cheap. Yields (fn, rows, fps) for every file in paths order. '''
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        pending = collections.deque()
+        for fn in paths:
+            pending.append((fn, pool.submit(scan_file, fn, regex)))
+            if len(pending) >= workers * 4:
+                fn, future = pending.popleft()
+                yield (fn, *future.result())
+        while pending:
+            fn, future = pending.popleft()
+            yield (fn, *future.result())
+
+
+#-----------------------------------------------------------------------------------
+def walk_folders(folders, exclude_dirs=(), exclude_files=()):
+    ''' Yields the files in folders and below, each once. Hidden directories are skipped, as are names
+    matching the exclude glob patterns. '''
+    seen = set()
+    for folder in folders:
+        for dir, dirs, names in os.walk(folder):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.') and not any(fnmatch.fnmatch(d, p) for p in exclude_dirs))
+            for name in sorted(names):
+                fn = os.path.join(dir, name)
+                if fn not in seen and not any(fnmatch.fnmatch(name, p) for p in exclude_files):
+                    seen.add(fn)
+                    yield fn
+
+
+#-----------------------------------------------------------------------------------
+def _parse_sigs(entry):
+    ''' A file entry in a shard or journal is a list of rows, or a dict of rows and fps. Returns (rows, fps). '''
+    if isinstance(entry, dict):
+        rows = entry.get('rows', [])
+        fps = entry.get('fps', [])
+        if len(fps) != len(rows):
+            fps = [0] * len(rows)
+    else:
+        rows = entry
+        fps = [0] * len(rows)
+    pairs = [(r, fp) for r, fp in zip(rows, fps) if r > 0]
+    return make_fps([r for r, _ in pairs], [fp for _, fp in pairs])
+
+
+#-----------------------------------------------------------------------------------
+def _find_missing(paths):
+    ''' Returns the set of paths that don't exist. One directory listing per directory rather than a stat per path. '''
+    by_dir = {}
+    for path in paths:
+        dir, name = os.path.split(path)
+        by_dir.setdefault(dir, []).append(name)
+
+    missing = set()
+    for dir, names in by_dir.items():
+        try:
+            present = {os.path.normcase(n) for n in os.listdir(dir)}
+        except OSError:
+            present = set()
+        for name in names:
+            if os.path.normcase(name) not in present:
+                missing.add(os.path.join(dir, name))
+    return missing
+
+
+#-----------------------------------------------------------------------------------
+def _apply_journal_rec(proj_sigs, rec):
+    ''' Apply one journal record to the signets of a project. '''
+    if rec.get('op') == 'clear':
+        proj_sigs.clear()
+    elif rec.get('op') == 'set':
+        rows = rec.get('rows', [])
+        if len(rows) > 0:
+            proj_sigs[rec['fn']] = {'rows': rows, 'fps': rec.get('fps', [])}
+        else:
+            proj_sigs.pop(rec['fn'], None)
+
+
+#-----------------------------------------------------------------------------------
+def _read_shard(proj_fn, store_fn):
+    ''' The snapshot in a shard file as {fn: entry}, and its format. Empty if there isn't one. '''
+    if not os.path.isfile(store_fn):
+        return {}, None
+
+    with open(store_fn, 'r') as fp:
+        proj_sigs = json.load(fp)
+    if proj_sigs.get('format') == 'compact':
+        return _decode_compact(proj_fn, proj_sigs), 'compact'
+    return proj_sigs, 'json'
+
+
+#-----------------------------------------------------------------------------------
+def _read_journal(journal_fn, offset=0):
+    ''' Journal records from offset on. A torn last line from a crash is ignored. Returns (recs, size). '''
+    recs = []
+    if not os.path.isfile(journal_fn):
+        return recs, 0
+
+    with open(journal_fn, 'rb') as fp:
+        fp.seek(offset)
+        data = fp.read()
+    for line in data.decode('utf-8', errors='replace').splitlines():
+        try:
+            recs.append(json.loads(line))
+        except ValueError:
+            continue
+    return recs, offset + len(data)
+
+
+#-----------------------------------------------------------------------------------
+def _write_shard(proj_fn, store_fn, journal_fn, proj_sigs, store_format):
+    ''' Hold the store lock. Replace the shard then start a fresh journal. proj_sigs is {fn: entry}. '''
+    entries = {}
+    for fn, entry in proj_sigs.items():
+        rows, fps = _parse_sigs(entry)
+        if len(rows) > 0:
+            entries[fn] = {'rows': list(rows), 'fps': list(fps)}
+
+    if store_format == 'compact':
+        _write_json(store_fn, _encode_compact(proj_fn, entries), indent=None)
+    else:
+        _write_json(store_fn, entries)
+    # Replaying is idempotent so a crash before this just means a longer journal next time.
+    with open(journal_fn, 'w'):
+        pass
+
+
+#-----------------------------------------------------------------------------------
+def _encode_compact(proj_fn, proj_sigs):
+    ''' proj_sigs is {fn: {'rows', 'fps'}}. Compact shard layout. Each directory is stored once, relative to the
+    project if it's under it, and rows are stored as the difference from the previous one:
+    {'format': 'compact', 'dirs': [dir], 'files': [[dir index, name, row deltas, fps]]} '''
+    root = os.path.dirname(proj_fn)
+    dirs = {}
+    files = []
+    for fn in sorted(proj_sigs):
+        dir, name = os.path.split(fn)
+        if dir == root:
+            dir = ''
+        elif dir.startswith(root + os.sep):
+            dir = dir[len(root) + 1:]
+        dir_index = dirs.setdefault(dir, len(dirs))
+
+        rows, fps = proj_sigs[fn]['rows'], proj_sigs[fn]['fps']
+        deltas = [rows[i] - rows[i - 1] if i > 0 else rows[i] for i in range(len(rows))]
+        files.append([dir_index, name, deltas, list(fps)])
+
+    return {'format': 'compact', 'dirs': list(dirs), 'files': files}
+
+
+#-----------------------------------------------------------------------------------
+def _decode_compact(proj_fn, data):
+    ''' Opposite of _encode_compact(). Returns the same as the json format. '''
+    root = os.path.dirname(proj_fn)
+    dirs = [os.path.join(root, dir) if dir != '' else root for dir in data['dirs']]
+    proj_sigs = {}
+    for dir_index, name, deltas, fps in data['files']:
+        rows = list(itertools.accumulate(deltas))
+        proj_sigs[os.path.join(dirs[dir_index], name)] = {'rows': rows, 'fps': fps}
+    return proj_sigs
+
+
+#-----------------------------------------------------------------------------------
+def _write_json(fn, data, indent=4):
+    ''' Write to a temp file then swap it in so a crash never leaves a truncated file. '''
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    temp_fn = fn + '.tmp'
+    with open(temp_fn, 'w') as fp:
+        json.dump(data, fp, indent=indent, separators=None if indent is not None else (',', ':'))
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(temp_fn, fn)
+
+
+#-----------------------------------------------------------------------------------
+def _append_file(fn, text):
+    ''' Writer thread. '''
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    with open(fn, 'a') as fp:
+        fp.write(text)
+
+
+#-----------------------------------------------------------------------------------
+def _remove_files(fns):
+    ''' Writer thread. '''
+    for fn in fns:
+        if os.path.isfile(fn):
+            os.remove(fn)
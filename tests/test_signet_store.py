@@ -0,0 +1,429 @@
+''' Tests for the signet store engine. No sublime needed. From the repo root:
+
+    python -m unittest discover tests
+'''
+import sys
+import os
+import re
+import json
+import glob
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from signet_store import SignetStore, PathResolver, line_fp, find_lines, relocate_rows
+
+
+STORE_NAME = 'SignetBookmarks'
+
+
+#-----------------------------------------------------------------------------------
+class StoreTestCase(unittest.TestCase):
+    ''' A project with some real files - the store drops signets for files that don't exist. '''
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='sbot_test_')
+        self.addCleanup(shutil.rmtree, self.root, ignore_errors=True)
+        self.store_dir = os.path.join(self.root, 'store')
+        self.proj_fn = self.make_file('proj/test.sublime-project', '{}')
+        self.files = [self.make_file(f'proj/dir{i % 2}/file{i}.txt', 'some text\n' * 20) for i in range(4)]
+
+        # What the stores post back from their writer threads, run by run_posted() on this thread.
+        self.posted = []
+
+    def make_file(self, rel, text=''):
+        fn = os.path.join(self.root, rel)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        with open(fn, 'w') as fp:
+            fp.write(text)
+        return fn
+
+    def make_store(self, **kwargs):
+        ''' A store on the test store dir, read and ready. '''
+        store = SignetStore(self.store_dir, STORE_NAME, post=self.posted.append, **kwargs)
+        store.read()
+        return store
+
+    def run_posted(self):
+        while len(self.posted) > 0:
+            self.posted.pop(0)()
+
+    def reload(self):
+        ''' What's on disk, as seen by a new store. '''
+        store = SignetStore(self.store_dir, STORE_NAME)
+        store.read()
+        return {fn: list(rows) for fn, rows in (store.get_project(self.proj_fn) or {}).items()}
+
+    def get_sigs(self, store):
+        return {fn: list(rows) for fn, rows in (store.get_project(self.proj_fn) or {}).items()}
+
+
+#-----------------------------------------------------------------------------------
+class TestPersistence(StoreTestCase):
+
+    def test_no_store(self):
+        store = SignetStore(self.store_dir, STORE_NAME)
+        self.assertFalse(store.read())
+        self.assertIsNone(store.get_project(self.proj_fn))
+
+    def test_toggle(self):
+        store = self.make_store()
+        fn = self.files[0]
+        self.assertTrue(store.toggle(self.proj_fn, fn, 5, line_fp('five')))
+        self.assertTrue(store.toggle(self.proj_fn, fn, 3, line_fp('three')))
+        self.assertTrue(store.toggle(self.proj_fn, fn, 9))
+        self.assertFalse(store.toggle(self.proj_fn, fn, 9))
+        store.save(wait=True)
+
+        self.assertEqual(self.reload(), {fn: [3, 5]})
+        other = self.make_store()
+        other.get_project(self.proj_fn)
+        self.assertEqual(list(other.get_fps(self.proj_fn, fn)), [line_fp('three'), line_fp('five')])
+
+    def test_clear_file(self):
+        store = self.make_store()
+        store.set_rows(self.proj_fn, self.files[0], [1, 2])
+        store.set_rows(self.proj_fn, self.files[1], [3])
+        store.save(wait=True)
+        store.clear_file(self.proj_fn, self.files[0])
+        store.save(wait=True)
+
+        self.assertEqual(self.reload(), {self.files[1]: [3]})
+
+    def test_clear_project(self):
+        store = self.make_store()
+        store.set_rows(self.proj_fn, self.files[0], [1, 2])
+        store.save(wait=True)
+        store.clear_project(self.proj_fn)
+        store.set_rows(self.proj_fn, self.files[1], [7])
+        store.save(wait=True)
+
+        self.assertEqual(self.reload(), {self.files[1]: [7]})
+
+    def test_compact(self):
+        store = self.make_store()
+        for i, fn in enumerate(self.files):
+            store.set_rows(self.proj_fn, fn, [i + 1, i + 10])
+        store.save(wait=True)
+        store.toggle(self.proj_fn, self.files[0], 1)
+        store.save(wait=True)
+        expected = self.get_sigs(store)
+
+        store.compact(self.proj_fn)
+        store.save(wait=True)
+        self.assertEqual(self.reload(), expected)
+
+        # Journal folded in and the version bumped.
+        journals = glob.glob(os.path.join(self.store_dir, 'shards', '*.journal'))
+        self.assertTrue(all(os.path.getsize(fn) == 0 for fn in journals))
+        with open(os.path.join(self.store_dir, STORE_NAME + '.manifest')) as fp:
+            self.assertEqual(json.load(fp)[self.proj_fn]['version'], 1)
+
+        # And more changes after it.
+        store.set_rows(self.proj_fn, self.files[3], [])
+        store.save(wait=True)
+        del expected[self.files[3]]
+        self.assertEqual(self.reload(), expected)
+
+    def test_compact_empty_project(self):
+        store = self.make_store()
+        store.set_rows(self.proj_fn, self.files[0], [1])
+        store.save(wait=True)
+        store.clear_project(self.proj_fn)
+        store.save(wait=True)
+        store.compact(self.proj_fn)
+        store.save(wait=True)
+
+        self.assertEqual(glob.glob(os.path.join(self.store_dir, 'shards', '*')), [])
+        self.assertEqual(self.reload(), {})
+
+    def test_missing_files_pruned(self):
+        store = self.make_store()
+        store.set_rows(self.proj_fn, self.files[0], [1])
+        store.set_rows(self.proj_fn, self.files[1], [2])
+        store.save(wait=True)
+        os.remove(self.files[0])
+
+        other = self.make_store()
+        other.get_project(self.proj_fn)
+        self.run_posted()
+        self.assertEqual(self.get_sigs(other), {self.files[1]: [2]})
+
+    def test_find_next(self):
+        store = self.make_store()
+        a, b = sorted(self.files)[:2]
+        store.set_rows(self.proj_fn, a, [3, 8])
+        store.set_rows(self.proj_fn, b, [5])
+
+        self.assertEqual(store.find_next(self.proj_fn, a, 3), (a, 8))
+        self.assertEqual(store.find_next(self.proj_fn, a, 8), (b, 5))
+        self.assertEqual(store.find_next(self.proj_fn, b, 5), (a, 3))
+        self.assertEqual(store.find_next(self.proj_fn, a, 3, forward=False), (b, 5))
+        self.assertEqual(store.find_next(self.proj_fn, a, 8, all_files=False), (a, 3))
+
+
+#-----------------------------------------------------------------------------------
+class TestMerge(StoreTestCase):
+    ''' Two stores sharing a store dir, like two ST instances. '''
+
+    def test_append_picks_up_journal(self):
+        a = self.make_store()
+        b = self.make_store()
+        b.get_project(self.proj_fn, create=True)
+
+        a.set_rows(self.proj_fn, self.files[0], [1])
+        a.save(wait=True)
+        b.set_rows(self.proj_fn, self.files[1], [2])
+        b.save(wait=True)
+        self.run_posted()
+        self.assertEqual(self.get_sigs(b), {self.files[0]: [1], self.files[1]: [2]})
+
+        a.set_rows(self.proj_fn, self.files[2], [3])
+        a.save(wait=True)
+        self.run_posted()
+        self.assertEqual(self.get_sigs(a), {self.files[0]: [1], self.files[1]: [2], self.files[2]: [3]})
+        self.assertEqual(self.reload(), self.get_sigs(a))
+
+    def test_append_picks_up_rewrite(self):
+        a = self.make_store()
+        a.set_rows(self.proj_fn, self.files[0], [1])
+        a.save(wait=True)
+        b = self.make_store()
+        b.get_project(self.proj_fn)
+
+        a.set_rows(self.proj_fn, self.files[2], [3])
+        a.compact(self.proj_fn)
+        a.save(wait=True)
+        b.set_rows(self.proj_fn, self.files[1], [2])
+        b.save(wait=True)
+        self.run_posted()
+
+        expected = {self.files[0]: [1], self.files[1]: [2], self.files[2]: [3]}
+        self.assertEqual(self.get_sigs(b), expected)
+        self.assertEqual(self.reload(), expected)
+
+    def test_fold_picks_up_journal(self):
+        a = self.make_store()
+        a.set_rows(self.proj_fn, self.files[0], [1])
+        a.save(wait=True)
+        b = self.make_store()
+        b.get_project(self.proj_fn)
+
+        a.set_rows(self.proj_fn, self.files[1], [2])
+        a.save(wait=True)
+        b.compact(self.proj_fn)
+        b.save(wait=True)
+        self.run_posted()
+
+        expected = {self.files[0]: [1], self.files[1]: [2]}
+        self.assertEqual(self.get_sigs(b), expected)
+        self.assertEqual(self.reload(), expected)
+
+    def test_own_changes_win(self):
+        a = self.make_store()
+        a.set_rows(self.proj_fn, self.files[0], [1])
+        a.save(wait=True)
+        b = self.make_store()
+        b.get_project(self.proj_fn)
+
+        a.set_rows(self.proj_fn, self.files[0], [2])
+        a.save(wait=True)
+        b.set_rows(self.proj_fn, self.files[0], [3])
+        b.save(wait=True)
+        self.run_posted()
+
+        self.assertEqual(self.get_sigs(b), {self.files[0]: [3]})
+        self.assertEqual(self.reload(), {self.files[0]: [3]})
+
+    def test_later_save_wins_over_append(self):
+        a = self.make_store()
+        a.get_project(self.proj_fn)
+        b = self.make_store()
+        b.set_rows(self.proj_fn, self.files[1], [3])
+        b.set_rows(self.proj_fn, self.files[2], [4])
+        b.save()
+        b.compact(self.proj_fn)
+        b.save(wait=True)
+
+        # Merge from the first save is still waiting when the second one goes.
+        a.set_rows(self.proj_fn, self.files[0], [1])
+        a.save(wait=True)
+        a.set_rows(self.proj_fn, self.files[1], [9])
+        a.save(wait=True)
+        self.run_posted()
+
+        expected = {self.files[0]: [1], self.files[1]: [9], self.files[2]: [4]}
+        self.assertEqual(self.get_sigs(a), expected)
+        self.assertEqual(self.reload(), expected)
+
+    def test_later_save_wins_over_fold(self):
+        a = self.make_store()
+        a.set_rows(self.proj_fn, self.files[0], [1])
+        a.save(wait=True)
+        b = self.make_store()
+        b.get_project(self.proj_fn)
+        b.set_rows(self.proj_fn, self.files[1], [3])
+        b.set_rows(self.proj_fn, self.files[2], [4])
+        b.save(wait=True)
+
+        a.compact(self.proj_fn)
+        a.set_rows(self.proj_fn, self.files[1], [9])
+        a.save(wait=True)
+        self.run_posted()
+
+        expected = {self.files[0]: [1], self.files[1]: [9], self.files[2]: [4]}
+        self.assertEqual(self.get_sigs(a), expected)
+        self.assertEqual(self.reload(), expected)
+
+    def test_other_clears(self):
+        a = self.make_store()
+        a.set_rows(self.proj_fn, self.files[0], [1])
+        a.set_rows(self.proj_fn, self.files[1], [2])
+        a.save(wait=True)
+        changed = []
+
+        def on_changed(proj_fn, fn, rows, foreign):
+            changed.append((fn, None if rows is None else list(rows), foreign))
+
+        b = self.make_store(on_changed=on_changed)
+        b.get_project(self.proj_fn)
+
+        a.clear_file(self.proj_fn, self.files[0])
+        a.save(wait=True)
+        b.set_rows(self.proj_fn, self.files[2], [3])
+        b.save(wait=True)
+        self.run_posted()
+
+        self.assertEqual(self.get_sigs(b), {self.files[1]: [2], self.files[2]: [3]})
+        self.assertIn((self.files[0], [], True), changed)
+
+
+#-----------------------------------------------------------------------------------
+class TestFormats(StoreTestCase):
+
+    def _round_trip(self, store_format):
+        outside = self.make_file('elsewhere/notes.txt', 'x\n')
+        top = self.make_file('proj/top.txt', 'x\n')
+        store = self.make_store()
+        store.store_format = store_format
+        store.set_rows(self.proj_fn, self.files[0], [1, 4, 9], [11, 44, 99])
+        store.set_rows(self.proj_fn, self.files[1], [2])
+        store.set_rows(self.proj_fn, outside, [5, 6])
+        store.set_rows(self.proj_fn, top, [1])
+        expected = self.get_sigs(store)
+        store.save()
+        store.compact(self.proj_fn)
+        store.save(wait=True)
+
+        shard_fn = glob.glob(os.path.join(self.store_dir, 'shards', '*.store'))[0]
+        with open(shard_fn) as fp:
+            data = json.load(fp)
+        self.assertEqual(data.get('format', 'json'), store_format)
+        self.assertEqual(self.reload(), expected)
+
+        other = self.make_store()
+        other.get_project(self.proj_fn)
+        self.assertEqual(list(other.get_fps(self.proj_fn, self.files[0])), [11, 44, 99])
+        return shard_fn
+
+    def test_compact(self):
+        shard_fn = self._round_trip('compact')
+        with open(shard_fn) as fp:
+            dirs = json.load(fp)['dirs']
+        self.assertEqual(sorted(dirs), sorted(['', 'dir0', 'dir1', os.path.join(self.root, 'elsewhere')]))
+
+    def test_json(self):
+        self._round_trip('json')
+
+    def test_format_change_rewrites(self):
+        shard_fn = self._round_trip('json')
+        store = SignetStore(self.store_dir, STORE_NAME)
+        store.store_format = 'compact'
+        store.read()
+        expected = self.get_sigs(store)
+        store.save(wait=True)
+
+        with open(shard_fn) as fp:
+            self.assertEqual(json.load(fp).get('format'), 'compact')
+        self.assertEqual(self.reload(), expected)
+
+
+#-----------------------------------------------------------------------------------
+class TestMigration(StoreTestCase):
+    ''' The old single SignetBookmarks.store plus journal. '''
+
+    def test_migrate(self):
+        gone_proj = os.path.join(self.root, 'gone', 'gone.sublime-project')
+        os.makedirs(self.store_dir)
+        with open(os.path.join(self.store_dir, STORE_NAME + '.store'), 'w') as fp:
+            json.dump({self.proj_fn: {self.files[0]: [3, 1], self.files[1]: {'rows': [2], 'fps': [22]}},
+                       gone_proj: {self.files[2]: [1]}}, fp)
+        with open(os.path.join(self.store_dir, STORE_NAME + '.journal'), 'w') as fp:
+            fp.write(json.dumps({'op': 'set', 'proj': self.proj_fn, 'fn': self.files[2], 'rows': [4]}) + '\n')
+            fp.write(json.dumps({'op': 'set', 'proj': self.proj_fn, 'fn': self.files[1], 'rows': []}) + '\n')
+
+        store = SignetStore(self.store_dir, STORE_NAME)
+        self.assertTrue(store.read())
+        self.assertEqual(self.get_sigs(store), {self.files[0]: [1, 3], self.files[2]: [4]})
+        self.assertIsNone(store.get_project(gone_proj))
+
+        self.assertTrue(os.path.isfile(os.path.join(self.store_dir, STORE_NAME + '.store.bak')))
+        self.assertFalse(os.path.isfile(os.path.join(self.store_dir, STORE_NAME + '.store')))
+        self.assertFalse(os.path.isfile(os.path.join(self.store_dir, STORE_NAME + '.journal')))
+        self.assertEqual(self.reload(), {self.files[0]: [1, 3], self.files[2]: [4]})
+
+
+#-----------------------------------------------------------------------------------
+class TestPaths(StoreTestCase):
+
+    def test_resolver(self):
+        link = os.path.join(self.root, 'link')
+        os.symlink(os.path.join(self.root, 'proj'), link)
+        resolver = PathResolver(max_dirs=2)
+        fn = resolver.resolve(self.files[0])
+        self.assertEqual(resolver.resolve(os.path.join(link, 'dir0', 'file0.txt')), fn)
+        self.assertEqual(resolver.resolve(os.path.join(self.root, 'proj', 'dir1', '..', 'dir0', 'file0.txt')), fn)
+        self.assertLessEqual(len(resolver._dirs), 2)
+        self.assertIsNone(resolver.resolve(None))
+
+    def test_unresolved_keys_merged(self):
+        link = os.path.join(self.root, 'link')
+        os.symlink(os.path.join(self.root, 'proj'), link)
+        linked = os.path.join(link, 'dir0', 'file0.txt')
+        store = self.make_store()
+        store.set_rows(self.proj_fn, linked, [1, 2])
+        store.set_rows(self.proj_fn, self.files[0], [5])
+        store.save(wait=True)
+
+        resolver = PathResolver()
+        store = self.make_store(resolve_path=resolver.resolve)
+        store.get_project(self.proj_fn)
+        self.run_posted()
+        self.assertEqual(self.get_sigs(store), {resolver.resolve(self.files[0]): [1, 2, 5]})
+        store.save(wait=True)
+        self.assertEqual(self.reload(), {self.files[0]: [1, 2, 5]})
+
+
+#-----------------------------------------------------------------------------------
+class TestText(unittest.TestCase):
+
+    def test_find_lines(self):
+        rows, fps = find_lines('a TODO\nb\nTODO TODO\n\nend TODO', re.compile('TODO'))
+        self.assertEqual(list(rows), [1, 3, 5])
+        self.assertEqual(list(fps), [line_fp('a TODO'), line_fp('TODO TODO'), line_fp('end TODO')])
+
+    def test_relocate(self):
+        lines = ['one', 'two', 'three', 'two']
+        fps = [line_fp('one'), line_fp('two'), line_fp('gone')]
+        rows, new_fps, lost = relocate_rows([1, 2, 5], fps, ['new'] + lines)
+        self.assertEqual((list(rows), list(new_fps), lost), ([2, 3, 5], [fps[0], fps[1], fps[2]], 1))
+
+        # Nearest of several.
+        rows, _, lost = relocate_rows([6], [line_fp('two')], ['new'] + lines)
+        self.assertEqual((list(rows), lost), ([5], 0))
+
+
+if __name__ == '__main__':
+    unittest.main()